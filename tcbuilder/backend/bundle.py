@@ -10,20 +10,35 @@ import subprocess
 import sys
 import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 import docker
 import docker.errors
 import docker.types
+import requests
 import yaml
 
+# Use the libyaml based (C) implementations when PyYAML was built with them.
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
 from tcbuilder.errors import (InvalidArgumentError, OperationFailureError,
                               InvalidStorageDriverError)
-from tcbuilder.backend.common import get_own_network, validate_compose_file
+from tcbuilder.backend.common import (get_own_network, validate_compose_file,
+                                      write_unpacked_size)
 from tcbuilder.backend.registryops import RegistryOperations
 
 log = logging.getLogger("torizon." + __name__)
 
+# Maximum number of container images being fetched at the same time.
+MAX_PARALLEL_PULLS = 8
+
+# Host and port of a DOCKER_HOST URL such as "tcp://docker:2375".
+DOCKER_HOST_RE = re.compile(r"tcp?://(\[[^\]]*\]|[^:/]+):(\d*)")
+
 
 def get_compression_command(output_file):
     """Get compression command
@@ -39,7 +54,7 @@ def get_compression_command(output_file):
     output_file_tar = output_file
     if output_file.endswith(".xz"):
         output_file_tar = output_file[:-3]
-        command = ["xz", "-3", "-z", output_file_tar]
+        command = ["xz", "-3", "-z", "-T0", output_file_tar]
     elif output_file.endswith(".gz"):
         output_file_tar = output_file[:-3]
         command = ["gzip", output_file_tar]
@@ -51,7 +66,7 @@ def get_compression_command(output_file):
         command = ["lz4", "-1", "-z", output_file, output_file_tar]
     elif output_file.endswith(".zst"):
         output_file_tar = output_file[:-4]
-        command = ["zstd", "--rm", output_file_tar, "-o", output_file]
+        command = ["zstd", "-T0", "--rm", output_file_tar, "-o", output_file]
     elif not output_file.endswith(".tar"):
         output_file_tar = f"{output_file}.tar"
 
@@ -72,7 +87,8 @@ class DockerManager:
         self.output_dir = output_dir
         self.output_dir_host = output_dir
 
-    def start(self, network_name=None, default_platform=None, dind_params=None):
+    def start(self, network_name=None, default_platform=None, dind_params=None,
+              tmpfs_size=None, registry_cache=False):
         """Start manager (dummy implementation)"""
 
     def stop(self):
@@ -132,6 +148,16 @@ class DindManager(DockerManager):
     DIND_VOLUME_NAME = "dind-volume"
     DIND_CONTAINER_NAME = "tcb-fetch-dind"
     TAR_CONTAINER_NAME = "tcb-build-tar"
+    # Pull-through cache of Docker Hub kept across runs (never removed by us).
+    REGISTRY_CACHE_IMAGE = "registry:2"
+    REGISTRY_CACHE_NAME = "tcb-registry-cache"
+    REGISTRY_CACHE_VOLUME_NAME = "tcb-registry-cache"
+    REGISTRY_CACHE_PORT = 22377
+    REGISTRY_CACHE_REMOTE = "https://registry-1.docker.io"
+    # Readiness polling of the DinD instance (in seconds).
+    POLL_INTERVAL = 0.1
+    CERTS_TIMEOUT = 30
+    DAEMON_TIMEOUT = 15
 
     def __init__(self, output_dir, host_workdir):
         super(DindManager, self).__init__(output_dir)
@@ -176,6 +202,7 @@ class DindManager(DockerManager):
         self.docker_host = None
         self.dind_volume = None
         self.dind_container = None
+        self.dind_client = None
 
     def _wait_certs(self):
         # Wait until TLS certificate is generated
@@ -186,15 +213,12 @@ class DindManager(DockerManager):
         ]
 
         success = False
-        for _retry in range(30):
-            time.sleep(1)
+        deadline = time.monotonic() + self.CERTS_TIMEOUT
+        while time.monotonic() < deadline:
             if all(os.path.exists(file) for file in needed_files):
                 success = True
                 break
-
-        # The simple presence of the files does not ensure the other process has
-        # finished writing them: add some time here as an imperfect safeguard.
-        time.sleep(1)
+            time.sleep(self.POLL_INTERVAL)
 
         if not success:
             raise OperationFailureError(
@@ -203,12 +227,131 @@ class DindManager(DockerManager):
                 f"{self.cert_dir} is a shared location between this script and "
                 "the Docker host.")
 
-    def start(self, network_name="fetch-dind-network",
-              default_platform=None, dind_params=None):
+    def _wait_daemon(self, client):
+        # The presence of the certificates does not ensure the daemon is up nor
+        # that the other process has finished writing them: retry until the
+        # daemon answers to a ping over TLS.
+        deadline = time.monotonic() + self.DAEMON_TIMEOUT
+        while True:
+            try:
+                client.ping()
+                return
+            except (docker.errors.DockerException,
+                    requests.exceptions.RequestException, OSError) as exc:
+                if time.monotonic() >= deadline:
+                    raise OperationFailureError(
+                        "The Docker in Docker instance did not become ready at "
+                        f"\"{self.docker_host}\": {exc}") from exc
+            time.sleep(self.POLL_INTERVAL)
+
+    def _start_registry_cache(self, network_name):
+        """Start (or reuse) the registry cache container
+
+        :return: The DinD program arguments to fetch images through the cache.
+        """
+        try:
+            cache = self.host_client.containers.get(self.REGISTRY_CACHE_NAME)
+        except docker.errors.NotFound:
+            cache = self._run_registry_cache(network_name)
+        else:
+            # A container on the host network cannot join other networks and
+            # vice versa: recreate it if it was created for the other mode or
+            # listens on another address (the cached data is kept in the volume).
+            http_addr_env = f"REGISTRY_HTTP_ADDR={self._registry_cache_http_addr(network_name)}"
+            if ((cache.attrs["HostConfig"]["NetworkMode"] == "host") != (network_name == "host")
+                    or http_addr_env not in (cache.attrs["Config"]["Env"] or [])):
+                log.info("Recreating registry cache container for network "
+                         f"\"{network_name}\"")
+                cache.remove(force=True)
+                cache = self._run_registry_cache(network_name)
+
+        if cache.status != "running":
+            cache.start()
+
+        if network_name == "host":
+            cache_addr = f"127.0.0.1:{self.REGISTRY_CACHE_PORT}"
+        else:
+            cache.reload()
+            networks = cache.attrs["NetworkSettings"]["Networks"]
+            if network_name not in networks:
+                self.host_client.networks.get(network_name).connect(cache)
+                cache.reload()
+                networks = cache.attrs["NetworkSettings"]["Networks"]
+            cache_ip = networks.get(network_name, {}).get("IPAddress")
+            if not cache_ip:
+                raise OperationFailureError(
+                    "Could not determine the address of the registry cache container "
+                    f"on network \"{network_name}\".")
+            cache_addr = f"{cache_ip}:{self.REGISTRY_CACHE_PORT}"
+
+        log.debug(f"Using registry cache at {cache_addr}")
+        return [f"--registry-mirror=http://{cache_addr}",
+                f"--insecure-registry={cache_addr}"]
+
+    def _registry_cache_http_addr(self, network_name):
+        """Get the address the registry cache container listens on
+
+        On the host network the cache would otherwise be reachable from the
+        whole LAN, so it only listens on the loopback interface there.
+        """
+        if network_name == "host":
+            return f"127.0.0.1:{self.REGISTRY_CACHE_PORT}"
+        return f"0.0.0.0:{self.REGISTRY_CACHE_PORT}"
+
+    def _run_registry_cache(self, network_name):
+        """Create and start the registry cache container
+
+        The container is left behind on purpose (so are its data in the volume);
+        it can be removed with `docker rm -f tcb-registry-cache` and the cached
+        data with `docker volume rm tcb-registry-cache`.
+        """
+        log.info("Starting registry cache container")
+        _mounts = [
+            docker.types.Mount(
+                source=self.REGISTRY_CACHE_VOLUME_NAME,
+                type='volume',
+                target='/var/lib/registry/',
+                read_only=False
+            )
+        ]
+        _environ = {
+            'REGISTRY_HTTP_ADDR': self._registry_cache_http_addr(network_name),
+            'REGISTRY_PROXY_REMOTEURL': self.REGISTRY_CACHE_REMOTE
+        }
+        return self.host_client.containers.run(
+            self.REGISTRY_CACHE_IMAGE,
+            environment=_environ,
+            mounts=_mounts,
+            network=network_name,
+            name=self.REGISTRY_CACHE_NAME,
+            restart_policy={"Name": "unless-stopped"},
+            detach=True)
+
+    def _create_dind_volume(self, tmpfs_size=None):
+        """Create the volume to hold the /var/lib/docker data of DinD"""
+        # Notice that a tmpfs volume is only kept while mounted by some
+        # container which is fine because the DinD container runs until the
+        # tarball is saved.
+        _driver_opts = None
+        if tmpfs_size is not None:
+            log.debug(f"Using tmpfs of size {tmpfs_size} for the DinD storage")
+            _driver_opts = {"type": "tmpfs", "device": "tmpfs", "o": f"size={tmpfs_size}"}
+        return self.host_client.volumes.create(
+            name=self.DIND_VOLUME_NAME, driver="local", driver_opts=_driver_opts)
+
+    def start(self, network_name="fetch-dind-network", default_platform=None,
+              dind_params=None, tmpfs_size=None, registry_cache=False):
         """Start manager
 
         This will start the Docker-in-Docker container which can then be used
         to perform other operations such as pulling images from a registry.
+
+        :param tmpfs_size: When set, the Docker storage of the DinD instance is
+                           kept in a tmpfs (RAM-backed) volume of the given size
+                           (e.g. "8g") instead of a disk-backed one.
+        :param registry_cache: Whether to fetch images from Docker Hub through
+                               a pull-through cache container which is kept
+                               (along with its volume) between runs.
         """
 
         log.info("\nStarting DIND container")
@@ -225,10 +368,10 @@ class DindManager(DockerManager):
                 # In case we use a Docker host, also connect to that host to
                 # reach the DIND instance (Gitlab CI case)
                 docker_host = os.environ["DOCKER_HOST"]
-                results = re.findall(r"tcp?:\/\/(.*):(\d*)\/?.*", docker_host)
-                if not results or len(results) < 1:
+                match = DOCKER_HOST_RE.match(docker_host)
+                if match is None:
                     raise Exception("Regex does not match: {}".format(docker_host))
-                host_ip = results[0][0]
+                host_ip = match.group(1)
                 self.docker_host = f"tcp://{host_ip}:{port}"
             else:
                 self.docker_host = f"tcp://127.0.0.1:{port}"
@@ -238,8 +381,7 @@ class DindManager(DockerManager):
             ports = {f"{port}/tcp": port}
             dind_cmd.append(f"--host=tcp://0.0.0.0:{port}")
 
-        # Create the volume to hold the /var/lib/docker data.
-        self.dind_volume = self.host_client.volumes.create(name=self.DIND_VOLUME_NAME)
+        self.dind_volume = self._create_dind_volume(tmpfs_size)
 
         # The workdir below is for the DinD instance.
         _environ = {
@@ -265,6 +407,9 @@ class DindManager(DockerManager):
         ]
         log.debug(f"Volume mapping for DinD: {_mounts}")
 
+        if registry_cache:
+            dind_cmd.extend(self._start_registry_cache(network_name))
+
         # Augment DinD program arguments.
         if dind_params is not None:
             dind_cmd.extend(dind_params)
@@ -297,20 +442,34 @@ class DindManager(DockerManager):
         """
 
         log.info("Stopping DIND container")
+        if self.dind_client is not None:
+            self.dind_client.close()
+            self.dind_client = None
         if self.dind_container is not None:
             self.dind_container.stop()
+            # The container is auto-removed: the volume can only be removed
+            # after that has happened.
+            try:
+                self.dind_container.wait(condition="removed")
+            except docker.errors.NotFound:
+                pass
         # Remove certs directory generated by DinD.
         if os.path.exists(self.cert_dir):
             shutil.rmtree(self.cert_dir)
-        # Otherwise Docker API throws exceptions...
-        time.sleep(1)
         if self.dind_volume is not None:
             self.dind_volume.remove()
         if self.network is not None:
             self.network.remove()
 
     def get_client(self):
-        """Create a client object associated to the DinD instance"""
+        """Get the client object associated to the DinD instance
+
+        The client (and its pool of TLS connections) is created on the first
+        call and shared by subsequent calls until the manager is stopped.
+        """
+
+        if self.dind_client is not None:
+            return self.dind_client
 
         # Wait until certificates are generated.
         self._wait_certs()
@@ -323,7 +482,11 @@ class DindManager(DockerManager):
                          os.path.join(self.cert_dir, 'client', 'key.pem')))
 
         log.info(f"Connecting to Docker Daemon at \"{self.docker_host}\"")
+        # Notice the default pool size of docker-py already allows for one
+        # connection per concurrent pull (MAX_PARALLEL_PULLS).
         dind_client = docker.DockerClient(base_url=self.docker_host, tls=tls_config)
+        self._wait_daemon(dind_client)
+        self.dind_client = dind_client
         return dind_client
 
     def save_tar(self, output_file):
@@ -389,7 +552,9 @@ class DindManager(DockerManager):
             output_filepath = os.path.join(self.bundle_dir, output_file)
             if os.path.exists(output_filepath):
                 os.remove(output_filepath)
+            tar_size = os.path.getsize(output_filepath_tar)
             subprocess.run(compression_command, cwd=self.bundle_dir, check=True)
+            write_unpacked_size(output_filepath, tar_size)
         else:
             log.debug(f"Not compressing {output_file_tar}")
 
@@ -473,6 +638,56 @@ def show_pull_progress_xterm(pull_stream):
         # print(res)
 
 
+def pull_images(client, images, platform=None, show_progress=True):
+    """Fetch multiple container images
+
+    When progress information is requested the images are fetched one at a
+    time (the XTerm based display can only handle a single pull stream);
+    otherwise they are fetched concurrently so that the total time is bound
+    by the slowest download rather than by the sum of all of them.
+
+    :param client: A DockerClient object to use on the operations.
+    :param images: Dictionary mapping a key (e.g. service name) to the name
+                   of the image to fetch.
+    :param platform: Container Platform to fetch (if an image is multi-arch
+                     capable).
+    :param show_progress: Whether or not to show progress of the pull process.
+    :return: Dictionary mapping the same keys to the fetched Image objects.
+    """
+
+    if show_progress:
+        fetched = {}
+        for key, image_name in images.items():
+            log.info(f"Fetching container image {image_name}")
+            # Use low-level API to get progress information.
+            res_stream = client.api.pull(
+                image_name, stream=True, decode=True, platform=platform)
+            show_pull_progress_xterm(res_stream)
+            fetched[key] = client.images.get(image_name)
+        return fetched
+
+    if not images:
+        return {}
+
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_PULLS, len(images))) as executor:
+        futures = {}
+        for key, image_name in images.items():
+            log.info(f"Fetching container image {image_name}")
+            # Use high-level API (no progress info).
+            futures[executor.submit(client.images.pull, image_name, platform=platform)] = key
+        try:
+            for future in as_completed(futures):
+                fetched[futures[future]] = future.result()
+        except Exception:
+            # Do not start any pull still waiting in the queue.
+            for future in futures:
+                future.cancel()
+            raise
+
+    return fetched
+
+
 def login_to_registries(client, logins):
     """Log in to multiple registries
 
@@ -529,7 +744,8 @@ def recursive_yaml_value_check(obj, config_path):
 def download_containers_by_compose_file(
         output_dir, compose_file, host_workdir, output_filename,
         keep_double_dollar_sign=False, platform=None, dind_params=None,
-        use_host_docker=False, show_progress=True):
+        use_host_docker=False, show_progress=True, tmpfs_size=None,
+        registry_cache=False):
     """
     Creates a container bundle using Docker (either Host Docker or Docker in Docker)
 
@@ -554,6 +770,10 @@ def download_containers_by_compose_file(
     :param show_progress: Whether or not to show progress of the pull process;
                           only relevant when there is a TTY attached to stdout
                           and the terminal is compatible with an xterm.
+    :param tmpfs_size: Size of the tmpfs holding the Docker storage of the
+                       Docker in Docker instance; None to use a disk volume.
+    :param registry_cache: Fetch Docker Hub images through a persistent
+                           pull-through cache (Docker in Docker only).
     """
     # Open Docker Compose file
     if not os.path.isabs(compose_file):
@@ -575,7 +795,7 @@ def download_containers_by_compose_file(
             show_progress = False
 
     with open(compose_path, encoding='utf-8') as file:
-        compose_file_data = yaml.safe_load(file)
+        compose_file_data = yaml.load(file, Loader=SafeLoader)
 
     # Basic compose file validation e.g. if it has 'services' section, images are specified, etc.
     validate_compose_file(compose_file_data)
@@ -594,7 +814,8 @@ def download_containers_by_compose_file(
     cacerts = RegistryOperations.get_cacerts()
     logins = RegistryOperations.get_logins()
     try:
-        manager.start(network, default_platform=platform, dind_params=dind_params)
+        manager.start(network, default_platform=platform, dind_params=dind_params,
+                      tmpfs_size=tmpfs_size, registry_cache=registry_cache)
         manager.add_cacerts(cacerts)
 
         dind_client = manager.get_client()
@@ -606,27 +827,23 @@ def download_containers_by_compose_file(
             login_to_registries(dind_client, logins)
 
         # Now we can fetch the containers...
+        images_to_fetch = {}
         for svc_name, svc_spec in compose_file_data['services'].items():
             image_name = svc_spec.get('image')
-            log.info(f"Fetching container image {image_name} in service {svc_name}")
+            log.debug(f"Service {svc_name} uses container image {image_name}")
             if not ":" in image_name:
                 image_name += ":latest"
+            images_to_fetch[svc_name] = image_name
 
-            if show_progress:
-                # Use low-level API to get progress information.
-                res_stream = dind_client.api.pull(
-                    image_name, stream=True, decode=True, platform=platform)
-                show_pull_progress_xterm(res_stream)
-                image = dind_client.images.get(image_name)
-            else:
-                # Use high-level API (no progress info).
-                image = dind_client.images.pull(image_name, platform=platform)
+        images = pull_images(dind_client, images_to_fetch,
+                             platform=platform, show_progress=show_progress)
 
-            svc_spec['image'] = image.attrs['RepoDigests'][0]
+        for svc_name, image in images.items():
+            compose_file_data['services'][svc_name]['image'] = image.attrs['RepoDigests'][0]
 
         log.info("Saving Docker Compose file")
         with open(os.path.join(manager.output_dir, "docker-compose.yml"), "w") as file:
-            file.write(yaml.safe_dump(compose_file_data))
+            yaml.dump(compose_file_data, file, Dumper=SafeDumper)
 
         log.info("Exporting storage")
         manager.save_tar(output_filename)
@@ -3,14 +3,17 @@ import shutil
 import logging
 import re
 import datetime
+import fcntl
+
+from concurrent.futures import ThreadPoolExecutor
 
-import fnmatch
 import guestfs
 
 from tezi.image import ImageConfig
 from tcbuilder.backend.common import \
     (set_output_ownership, check_licence_acceptance,
-     run_with_loading_animation, DOCKER_BUNDLE_TARNAME)
+     run_with_loading_animation, read_unpacked_size,
+     invalidate_rootfs_tarball_cache, DOCKER_BUNDLE_TARNAME, UNPACKED_SIZE_SUFFIX)
 from tcbuilder.errors import InvalidStateError, InvalidDataError, TorizonCoreBuilderError
 
 log = logging.getLogger("torizon." + __name__)
@@ -42,16 +45,60 @@ TAR_EXT_TO_COMPRESSION_TYPE = {
     ".tar": None
 }
 
+# Maximum number of files being copied into an image at the same time.
+MAX_PARALLEL_COPIES = 8
+
+# ioctl request to share the data extents of a file (reflink); from linux/fs.h.
+FICLONE = 0x40049409
+
 
 # Search in bundle_dir if there is a file named DOCKER_BUNDLE_TARNAME*
 # e.g. DOCKER_BUNDLE_TARNAME, DOCKER_BUNDLE_TARNAME.xz, DOCKER_BUNDLE_TARNAME.gz, etc.
 def check_docker_storage_file(bundle_dir):
-    for filename in os.listdir(bundle_dir):
-        if fnmatch.fnmatch(filename, f"{DOCKER_BUNDLE_TARNAME}*"):
-            return filename
+    with os.scandir(bundle_dir) as entries:
+        for entry in entries:
+            if (entry.name.startswith(DOCKER_BUNDLE_TARNAME) and
+                    not entry.name.endswith(UNPACKED_SIZE_SUFFIX) and entry.is_file()):
+                return entry.name
     return None
 
 
+def _fast_copy(src, dst):
+    """Copy file `src` into file `dst` avoiding user-space copies if possible
+
+    The file is cloned (reflink) when the filesystem supports it, otherwise
+    its contents are copied inside the kernel by copy_file_range(); as a last
+    resort shutil.copyfile() is used. Permission bits are copied as done by
+    shutil.copy().
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError(f"{src!r} and {dst!r} are the same file")
+
+    copied = False
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            copied = True
+        except OSError:
+            pass
+
+        if not copied:
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if count == 0:
+                        break
+                    remaining -= count
+                copied = remaining == 0
+            except OSError:
+                pass
+
+    if not copied:
+        shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+
+
 def set_autoreboot(output_dir, include):
     wrapup_sh = os.path.join(os.path.abspath(output_dir), 'wrapup.sh')
 
@@ -95,7 +142,7 @@ def set_autoreboot(output_dir, include):
         output.writelines(lines)
 
 
-def add_files(tezidir, image_json_filename, filelist, tezi_props):
+def add_files(tezidir, image_json_filename, filelist, tezi_props, unpacked_sizes=None):
 
     config_fname = os.path.join(tezidir, image_json_filename)
     config = ImageConfig(config_fname)
@@ -107,14 +154,15 @@ def add_files(tezidir, image_json_filename, filelist, tezi_props):
 
     if filelist:
         config.add_files(
-            filelist, image_dir=tezidir, update_size=True, fail_src_present=True)
+            filelist, image_dir=tezidir, update_size=True, fail_src_present=True,
+            unpacked_sizes=unpacked_sizes)
 
     # ---
     # FIXME: The code below should be factored out (separate adding files from setting props):
     # ---
     if tezi_props.get("name") is None:
         name_extra = ["", " with Containers"][bool(filelist)]
-        config["name"] = config["name"] + name_extra
+        config["name"] = f"{config['name']}{name_extra}"
     else:
         config["name"] = tezi_props["name"]
 
@@ -124,8 +172,8 @@ def add_files(tezidir, image_json_filename, filelist, tezi_props):
     # Rather ad-hoc for now, we probably want to give the user more control
     # FIXME: Here we assume that a filelist is always adding containers to the image.
     version_extra = [".modified", ".container"][bool(filelist)]
-    config["version"] = config["version"] + version_extra
-    config["release_date"] = datetime.datetime.today().strftime("%Y-%m-%d")
+    config["version"] = f"{config['version']}{version_extra}"
+    config["release_date"] = datetime.date.today().isoformat()
 
     if tezi_props.get("licence_file") is not None:
         config["license"] = tezi_props["licence_file"]
@@ -137,6 +185,7 @@ def add_files(tezidir, image_json_filename, filelist, tezi_props):
         config["autoinstall"] = tezi_props["autoinstall"]
 
     config.save()
+    invalidate_rootfs_tarball_cache()
 
     # Properties that are not in "image.json":
     if tezi_props.get("autoreboot") is not None:
@@ -145,20 +194,20 @@ def add_files(tezidir, image_json_filename, filelist, tezi_props):
     return config["version"]
 
 
-def update_tezi_files(image_dir, tezi_props, files_to_add=None):
+def update_tezi_files(image_dir, tezi_props, files_to_add=None, unpacked_sizes=None):
     licence_file_bn = None
     if tezi_props.get("licence_file") is not None:
         licence_file = tezi_props.get("licence_file")
         licence_file_bn = os.path.basename(licence_file)
-        shutil.copy(licence_file, os.path.join(image_dir, licence_file_bn))
+        _fast_copy(licence_file, os.path.join(image_dir, licence_file_bn))
         tezi_props["licence_file"] = licence_file_bn
 
     release_notes_file_bn = None
     if tezi_props.get("release_notes_file") is not None:
         release_notes_file = tezi_props.get("release_notes_file")
         release_notes_file_bn = os.path.basename(release_notes_file)
-        shutil.copy(release_notes_file,
-                    os.path.join(image_dir, release_notes_file_bn))
+        _fast_copy(release_notes_file,
+                   os.path.join(image_dir, release_notes_file_bn))
         tezi_props["release_notes_file"] = release_notes_file_bn
 
     version = None
@@ -169,7 +218,8 @@ def update_tezi_files(image_dir, tezi_props, files_to_add=None):
         "tezidir": image_dir,
         "image_json_filename": image_json_filepath,
         "filelist": files_to_add,
-        "tezi_props": tezi_props
+        "tezi_props": tezi_props,
+        "unpacked_sizes": unpacked_sizes
     }
     version = add_files(**add_files_params)
 
@@ -180,12 +230,27 @@ def combine_single_tezi_image(bundle_dir, files_to_add, output_dir, tezi_props):
     for prop in tezi_props:
         assert prop in TEZI_PROPS, f"Unknown property {prop} to combine_single_image"
 
-    for filename in files_to_add:
-        filename = filename.split(":")[0]
-        shutil.copy(os.path.join(bundle_dir, filename),
-                    os.path.join(output_dir, filename))
+    filenames = [filename.split(":")[0] for filename in files_to_add]
 
-    return update_tezi_files(output_dir, tezi_props, files_to_add)
+    # Copy the files concurrently: the copies happen inside the kernel.
+    if filenames:
+        with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_COPIES, len(filenames))) as executor:
+            futures = [
+                executor.submit(_fast_copy, os.path.join(bundle_dir, filename),
+                                os.path.join(output_dir, filename))
+                for filename in filenames
+            ]
+            for future in futures:
+                future.result()
+
+    # Unpacked sizes recorded when the bundle was created.
+    unpacked_sizes = {}
+    for filename in filenames:
+        size = read_unpacked_size(os.path.join(bundle_dir, filename))
+        if size is not None:
+            unpacked_sizes[filename] = size
+
+    return update_tezi_files(output_dir, tezi_props, files_to_add, unpacked_sizes)
 
 
 def check_combine_files(bundle_dir):
@@ -260,6 +325,27 @@ def combine_tezi_image(image_dir, bundle_dir, output_directory, tezi_props, forc
     combine_single_tezi_image(**combine_params)
 
 
+def _add_file_to_raw_image(gfs, bundle_dir, src, dest, untar):
+    """Copy (or unpack) file `src` of the bundle into directory `dest` of the image"""
+
+    if untar:
+        ext = os.path.splitext(src)[1].lower()
+        if ext not in TAR_EXT_TO_COMPRESSION_TYPE:
+            raise InvalidDataError(
+                f"Error: Unsupported compression format of {src} for raw images.")
+        run_with_loading_animation(
+            func=gfs.tar_in,
+            args=(os.path.join(bundle_dir, src), dest),
+            kwargs={'compress': TAR_EXT_TO_COMPRESSION_TYPE[ext]},
+            loading_msg=f"  Unpacking {src} to {dest} ...")
+
+    else:
+        run_with_loading_animation(
+            func=gfs.copy_in,
+            args=(os.path.join(bundle_dir, src), dest),
+            loading_msg=f"  Copying {src} to {dest} ...")
+
+
 def combine_raw_image(image_path, bundle_dir, output_path, rootfs_label, force):
 
     files_to_add = check_combine_files(bundle_dir)
@@ -323,18 +409,7 @@ def combine_raw_image(image_path, bundle_dir, output_path, rootfs_label, force):
                 if not gfs.is_dir(dest):
                     gfs.mkdir_p(dest)
 
-                if untar:
-                    run_with_loading_animation(
-                        func=gfs.tar_in,
-                        args=(os.path.join(bundle_dir, src), dest),
-                        kwargs={'compress': TAR_EXT_TO_COMPRESSION_TYPE[os.path.splitext(src)[1]]},
-                        loading_msg=f"  Unpacking {src} to {dest} ...")
-
-                else:
-                    run_with_loading_animation(
-                        func=gfs.copy_in,
-                        args=(os.path.join(bundle_dir, src), dest),
-                        loading_msg=f"  Copying {src} to {dest} ...")
+                _add_file_to_raw_image(gfs, bundle_dir, src, dest, untar)
 
             gfs.shutdown()
             gfs.close()
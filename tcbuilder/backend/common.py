@@ -1,4 +1,4 @@
-import ipaddress
+import functools
 import json
 import logging
 import os
@@ -33,6 +33,9 @@ log = logging.getLogger("torizon." + __name__)
 
 DOCKER_BUNDLE_TARNAME = "docker-storage.tar"
 
+# Suffix of the file storing the unpacked size of a (compressed) bundle tarball.
+UNPACKED_SIZE_SUFFIX = ".size"
+
 # Mapping from architecture to a Docker platform.
 ARCH_TO_DOCKER_PLAT = {
     "aarch64": "linux/arm64",
@@ -135,21 +138,66 @@ def print_spinner_animation(event):
             break
 
 
-def get_rootfs_tarball(tezi_image_dir):
-    if not os.path.exists(tezi_image_dir):
-        raise PathNotExistError(f"Source image {tezi_image_dir} directory does not exist")
+# Rootfs file names found by get_rootfs_tarball(), keyed by the path, mtime and
+# size of the image.json file they were read from.
+_rootfs_filenames = {}
 
+
+def get_rootfs_tarball(tezi_image_dir):
     image_json_filepath = os.path.join(tezi_image_dir, "image.json")
+    try:
+        jsonfile = open(image_json_filepath, "r", encoding="utf-8")
+    except FileNotFoundError:
+        # Only look at the directory itself to report the proper error.
+        if not os.path.exists(tezi_image_dir):
+            raise PathNotExistError(
+                f"Source image {tezi_image_dir} directory does not exist") from None
+        raise
+
+    with jsonfile:
+        image_json_stat = os.fstat(jsonfile.fileno())
+        cache_key = (image_json_filepath, image_json_stat.st_mtime_ns, image_json_stat.st_size)
+        filename = _rootfs_filenames.get(cache_key)
+        if filename is None:
+            # Find root file system content
+            content = tezi.utils.find_rootfs_content(json.load(jsonfile))
+            if content is None:
+                raise FileContentMissing(
+                    f"No root file system content section found in {image_json_filepath}")
+            filename = _rootfs_filenames[cache_key] = content["filename"]
 
-    with open(image_json_filepath, "r") as jsonfile:
-        jsondata = json.load(jsonfile)
+    return os.path.join(tezi_image_dir, filename)
 
-    # Find root file system content
-    content = tezi.utils.find_rootfs_content(jsondata)
-    if content is None:
-        raise FileContentMissing(f"No root file system content section found in {jsonfile}")
 
-    return os.path.join(tezi_image_dir, content["filename"])
+def invalidate_rootfs_tarball_cache():
+    """Forget the rootfs file names looked up by get_rootfs_tarball()
+
+    This must be called after writing or extracting an image.json file: the
+    new file could have the same modification time and size as the old one.
+    """
+    _rootfs_filenames.clear()
+
+
+def write_unpacked_size(filepath, size):
+    """Record the unpacked size of file `filepath` in a file next to it"""
+    with open(filepath + UNPACKED_SIZE_SUFFIX, "w", encoding="utf-8") as size_file:
+        size_file.write(f"{size}\n")
+
+
+def read_unpacked_size(filepath):
+    """Read the unpacked size of file `filepath` recorded by write_unpacked_size()
+
+    :return: The size in bytes or None if no (up-to-date) size is available.
+    """
+    size_filepath = filepath + UNPACKED_SIZE_SUFFIX
+    try:
+        if os.stat(size_filepath).st_mtime_ns < os.stat(filepath).st_mtime_ns:
+            log.debug(f"Ignoring stale {size_filepath}")
+            return None
+        with open(size_filepath, "r", encoding="utf-8") as size_file:
+            return int(size_file.read())
+    except (OSError, ValueError):
+        return None
 
 
 def add_bundle_directory_argument(parser):
@@ -257,20 +305,7 @@ def add_common_registry_arguments(subparser):
 
 def get_unpack_command(filename):
     """Get shell command to unpack a given file format"""
-    cmd = "cat"
-    if filename.endswith(".gz") or filename.endswith(".tgz"):
-        cmd = "gzip -dc"
-    elif filename.endswith(".xz"):
-        cmd = "xz -dc"
-    elif filename.endswith(".lzo"):
-        cmd = "lzop -dc"
-    elif filename.endswith(".zst"):
-        cmd = "zstd -dc"
-    elif filename.endswith(".lz4"):
-        cmd = "lz4 -dc"
-    elif filename.endswith(".bz2"):
-        cmd = "bzip2 -dc"
-    return cmd
+    return tezi.utils.get_unpack_command(filename)
 
 
 def get_tar_compress_program_options(filename):
@@ -304,6 +339,15 @@ def get_all_local_ip_addresses():
     return local_ip_addresses
 
 
+# Resolver configured manually for mDNS operation (shared by all lookups).
+MDNS_RESOLVER = dns.resolver.Resolver(configure=False)
+MDNS_RESOLVER.nameservers = ["224.0.0.251"]  # mDNS IPv4 link-local multicast address
+MDNS_RESOLVER.port = 5353  # mDNS port
+# Link-local mDNS responders answer well within this time (in seconds).
+MDNS_LIFETIME = 1.5
+
+
+@functools.lru_cache(maxsize=256)
 def resolve_hostname(hostname: str, mdns_source: Optional[str] = None) -> (str, bool):
     """
     Convert a hostname to ip using operating system's name resolution service
@@ -318,11 +362,13 @@ def resolve_hostname(hostname: str, mdns_source: Optional[str] = None) -> (str,
     Returns:
         str -- IP address as string
         bool - true id mdns has been used
+
+    Successful results are cached for the lifetime of the process.
     """
 
     try:
-        ip_addr = socket.gethostbyname(hostname)
-        return ip_addr, False
+        addrinfo = socket.getaddrinfo(hostname, None, socket.AF_INET, socket.SOCK_STREAM)
+        return addrinfo[0][4][0], False
     except socket.gaierror as sgex:
         # If its a mDNS compatible hostname, ignore regular resolve issues
         # and try mDNS next
@@ -334,13 +380,10 @@ def resolve_hostname(hostname: str, mdns_source: Optional[str] = None) -> (str,
     else:
         mdns_hostname = hostname + ".local"
 
-    # Configure Resolver manually for mDNS operation
-    resolver = dns.resolver.Resolver(configure=False)
-    resolver.nameservers = ["224.0.0.251"]  # mDNS IPv4 link-local multicast address
-    resolver.port = 5353  # mDNS port
     if mdns_source:
         try:
-            addr = resolver.query(mdns_hostname, "A", lifetime=3, source=mdns_source)
+            addr = MDNS_RESOLVER.query(mdns_hostname, "A",
+                                       lifetime=MDNS_LIFETIME, source=mdns_source)
             if addr is None or len(addr) == 0:
                 raise TorizonCoreBuilderError("Resolving mDNS address failed with no answer")
 
@@ -353,7 +396,8 @@ def resolve_hostname(hostname: str, mdns_source: Optional[str] = None) -> (str,
         mdns_addr = None
         for local_ip in get_all_local_ip_addresses():
             try:
-                mdns_addr = resolver.query(mdns_hostname, "A", lifetime=3, source=local_ip)
+                mdns_addr = MDNS_RESOLVER.query(mdns_hostname, "A",
+                                                lifetime=MDNS_LIFETIME, source=local_ip)
             except dns.exception.Timeout:
                 pass
             else:
@@ -365,15 +409,27 @@ def resolve_hostname(hostname: str, mdns_source: Optional[str] = None) -> (str,
             f'Resolving hostname "{mdns_hostname}" using mDNS on all interfaces failed.')
 
 
+def is_ip_address(address):
+    """Check if a string is an IPv4 or IPv6 address (the latter possibly with a scope)"""
+    try:
+        socket.inet_pton(socket.AF_INET, address)
+        return True
+    except OSError:
+        pass
+    try:
+        socket.inet_pton(socket.AF_INET6, address.split("%", 1)[0])
+        return True
+    except OSError:
+        return False
+
+
 def resolve_remote_host(remote_host, mdns_source=None):
     """Resolve given host to IP address if host is not an IP address already"""
-    try:
-        _ip_obj = ipaddress.ip_address(remote_host)
+    if is_ip_address(remote_host):
         return remote_host
-    except ValueError:
-        # This seems to be a host name, let's try to resolve it
-        ip_addr, _mdns = resolve_hostname(remote_host, mdns_source)
-        return ip_addr
+    # This seems to be a host name, let's try to resolve it
+    ip_addr, _mdns = resolve_hostname(remote_host, mdns_source)
+    return ip_addr
 
 
 def get_branch_and_major_from_metadata(storage_dir):
@@ -703,6 +759,24 @@ def set_output_ownership(output_file, set_parents=False):
                                     workdir_uid, workdir_gid)
 
 
+# Directory of the storage (relative to it) for the scratch files of the commands;
+# being in the same filesystem, files prepared there can be moved into the storage
+# by a rename.
+STORAGE_TMP_DIR = "tmp"
+
+# Directory of the storage (relative to it) for data cached between commands; it
+# is cleared along with the unpacked image (see `images.prepare_storage()`), so
+# nothing kept there can outlive the image it was derived from.
+STORAGE_CACHE_DIR = "cache"
+
+
+def get_storage_tmp_dir(storage_dir):
+    """Get (creating it if needed) the directory for scratch files of the storage."""
+    tmp_dir = os.path.join(storage_dir, STORAGE_TMP_DIR)
+    os.makedirs(tmp_dir, exist_ok=True)
+    return tmp_dir
+
+
 def images_unpack_executed(storage_dir):
     """
     Check both, if "storage_dir" exists and if a "torizoncore-builder images
@@ -20,7 +20,8 @@ from gi.repository import Gio, OSTree
 
 from tcbuilder.backend import ostree
 from tcbuilder.backend.common import (get_rootfs_tarball, resolve_remote_host,
-                                      run_with_loading_animation)
+                                      run_with_loading_animation,
+                                      invalidate_rootfs_tarball_cache)
 from tcbuilder.backend.rforward import reverse_forward_tunnel, request_port_forward
 from tcbuilder.errors import TorizonCoreBuilderError, InvalidDataError
 from tezi.utils import find_rootfs_content
@@ -166,13 +167,14 @@ def update_uncompressed_image_size(image_filename):
     content["uncompressed_size"] = float(uncompressed_image_size)
     with open(image_json, "w", encoding="utf-8") as jsonfile:
         json.dump(jsondata, jsonfile, indent=4)
+    invalidate_rootfs_tarball_cache()
 
 
 def create_installed_versions(path, ref, branch):
     with open(os.path.join(path, "installed_versions"), "w") as versionfile:
         versioninfo = {}
         versioninfo[ref] = branch + "-" + ref
-        json.dump(versioninfo, versionfile)
+        json.dump(versioninfo, versionfile, separators=(",", ":"))
 
 def copy_tezi_image(src_tezi_dir, dst_tezi_dir):
     shutil.copytree(src_tezi_dir, dst_tezi_dir)
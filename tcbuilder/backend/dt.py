@@ -2,14 +2,17 @@
 Backend for the DT (device-tree) related operations.
 """
 
+import functools
 import logging
 import json
 import os
-import shlex
+import re
 import subprocess
 import sys
 import io
 
+import libfdt
+
 log = logging.getLogger("torizon." + __name__)
 
 
@@ -80,16 +83,25 @@ def get_current_dtb_basename(storage_dir):
     return None
 
 
+def get_dtb_changes_dir(storage_dir):
+    '''Returns the directory that contains external changes to the kernel device trees.'''
+    return os.path.join(get_dt_changes_dir(storage_dir), get_dtb_kernel_subdir(storage_dir))
+
+
+@functools.lru_cache(maxsize=4)
 def get_dtb_kernel_subdir(storage_dir):
-    '''Returns "usr/lib/modules/<kernel_version/dtb".'''
+    '''Returns "usr/lib/modules/<kernel_version/dtb".
 
-    answer = subprocess.check_output(
-        ("set -o pipefail && "
-         f"find {storage_dir}/sysroot/ostree/deploy -type d -name dtb -print -quit |"
-         " sed -r -e 's|.*/(usr/lib/modules/)|\\1|'"),
-        shell=True, text=True).strip()
-    assert answer, "panic: missing kernel device tree directory!"
-    return answer
+    The answer is cached as it only changes when a new image is unpacked into
+    the storage directory; call `get_dtb_kernel_subdir.cache_clear()` then.
+    '''
+
+    dtb_dir = subprocess.check_output(
+        ["find", f"{storage_dir}/sysroot/ostree/deploy", "-type", "d", "-name", "dtb",
+         "-print", "-quit"],
+        text=True).strip()
+    assert dtb_dir, "panic: missing kernel device tree directory!"
+    return re.sub(r".*/(usr/lib/modules/)", r"\1", dtb_dir)
 
 
 def get_current_dtb_path(storage_dir):
@@ -106,8 +118,7 @@ def get_current_dtb_path(storage_dir):
     if dtb_basename:
         # Found a real definition of the device tree in boot loader configuration.
         # Find the path to this device tree, or die trying.
-        answer = os.path.join(get_dt_changes_dir(storage_dir),
-                              get_dtb_kernel_subdir(storage_dir), dtb_basename)
+        answer = os.path.join(get_dtb_changes_dir(storage_dir), dtb_basename)
         if os.path.exists(answer):
             # This is a recently applied device tree.
             return (answer, True)
@@ -129,6 +140,36 @@ def get_current_dtb_path(storage_dir):
     return (answer, False)
 
 
+def get_dtb_compatible_labels(dtb_path):
+    '''Return the labels of the root "compatible" property of the device tree blob.
+
+    Raises `libfdt.FdtException` if the file is not a valid device tree blob or
+    the property is missing.
+    '''
+    stat = os.stat(dtb_path)
+    return list(_read_dtb_compatible_labels(dtb_path, stat.st_mtime_ns, stat.st_size))
+
+
+@functools.lru_cache(maxsize=16)
+def _read_dtb_compatible_labels(dtb_path, _mtime_ns, _size):
+    '''Parse the blob; the modification time and size only serve as part of the cache key.
+
+    Blobs extracted from an image keep their original modification time, so the
+    cache must also be cleared when the storage (or a blob in it) gets replaced;
+    call `clear_dtb_compatible_labels_cache()` then.
+    '''
+    with open(dtb_path, "rb") as dtbf:
+        fdt = libfdt.Fdt(dtbf.read())
+    # The value of the property is a list of NUL-terminated strings.
+    compatible = bytes(fdt.getprop(0, "compatible"))
+    return tuple(label.decode() for label in compatible.rstrip(b"\0").split(b"\0"))
+
+
+def clear_dtb_compatible_labels_cache():
+    '''Forget the labels read by `get_dtb_compatible_labels()`.'''
+    _read_dtb_compatible_labels.cache_clear()
+
+
 def build_dts(source_dts_path, include_dirs, target_dtb_path):
     '''Compile the device tree source file 'source_dts_path' to 'target_dtb_path'.
        Returns True on successful compilation, False otherwise.
@@ -136,17 +177,19 @@ def build_dts(source_dts_path, include_dirs, target_dtb_path):
     opt_includes = []
     for include_dir in include_dirs:
         opt_includes.append("-I")
-        opt_includes.append(shlex.quote(include_dir))
-    opt_includes = " ".join(opt_includes)
+        opt_includes.append(include_dir)
     try:
-        subprocess.check_output(
-            ("set -o pipefail && "
-             f"cpp -nostdinc -undef -x assembler-with-cpp {opt_includes} "
-             f"{shlex.quote(source_dts_path)} "
-             f"| dtc -I dts -O dtb -@ -o {shlex.quote(target_dtb_path)}"),
-            shell=True, text=True, stderr=subprocess.STDOUT)
+        # Preprocess the source in memory and feed it to the compiler; keep it
+        # as bytes since sources are not necessarily valid in the locale encoding.
+        preprocessed = subprocess.run(
+            ["cpp", "-nostdinc", "-undef", "-x", "assembler-with-cpp", *opt_includes,
+             source_dts_path],
+            check=True, capture_output=True).stdout
+        subprocess.run(
+            ["dtc", "-I", "dts", "-O", "dtb", "-@", "-o", target_dtb_path],
+            input=preprocessed, check=True, capture_output=True)
     except subprocess.CalledProcessError as exc:
-        log.error(exc.output.strip())
+        log.error(exc.stderr.decode(errors="replace").strip())
         return False
     # pylint: disable=line-too-long
     # file does not necessarily return Device tree blob as file type. Therefore,
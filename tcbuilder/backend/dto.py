@@ -1,13 +1,26 @@
 """Backend implementation of dto subcommand."""
 
+import functools
+import hashlib
+import json
 import logging
 import os
+import re
 import subprocess
+import tempfile
 
 from tcbuilder.backend import dt
+from tcbuilder.backend.common import STORAGE_CACHE_DIR
 
 log = logging.getLogger("torizon." + __name__)
 
+# A "compatible" property whose first value is any of the labels given in
+# '{labels}'.
+COMPATIBLE_PROP_RE_TEMPLATE = r'^\s*compatible\s*=\s*"(?:{labels})"'
+
+# Results of previous compatibility scans, relative to the storage directory.
+COMPATIBLE_SCAN_CACHE = os.path.join(STORAGE_CACHE_DIR, "dto-compatible.json")
+
 
 def get_active_overlays_txt_path(storage_dir):
     """Query the path to the currently applied overlays.txt.
@@ -16,8 +29,7 @@ def get_active_overlays_txt_path(storage_dir):
     the boot loader that may or may not exist.
     """
 
-    path = os.path.join(dt.get_dt_changes_dir(storage_dir),
-                        dt.get_dtb_kernel_subdir(storage_dir), "overlays.txt")
+    path = os.path.join(dt.get_dtb_changes_dir(storage_dir), "overlays.txt")
     if os.path.exists(path):
         # There is a recently applied (but not yet deployed) overlays.txt.
         return path
@@ -49,9 +61,7 @@ def find_path_to_overlay(storage_dir, basename):
     (or die trying).
     """
 
-    path = os.path.join(dt.get_dt_changes_dir(storage_dir),
-                        dt.get_dtb_kernel_subdir(storage_dir),
-                        "overlays", basename)
+    path = os.path.join(dt.get_dtb_changes_dir(storage_dir), "overlays", basename)
     if os.path.exists(path):
         # There is a recently applied (but not yet deployed) overlay blob with
         # this base name.
@@ -74,6 +84,93 @@ def get_applied_overlay_paths(storage_dir, base_names=None):
     return [find_path_to_overlay(storage_dir, basename) for basename in base_names]
 
 
+@functools.lru_cache(maxsize=8)
+def get_compatible_prop_re(compat_labels):
+    """Get a single compiled regexp matching a "compatible" property with any of the labels.
+
+    :param compat_labels: tuple of labels.
+    """
+    labels = "|".join(re.escape(label) for label in compat_labels)
+    return re.compile(COMPATIBLE_PROP_RE_TEMPLATE.format(labels=labels), re.MULTILINE)
+
+
+def find_compatible_overlays(overlays_dir, compat_labels, cache_path=None):
+    """Find the overlay source files compatible with any of the given labels.
+
+    All files under 'overlays_dir' are searched (recursively) for a "compatible"
+    property having one of the labels as its first value.
+
+    :param cache_path: optional path to a file where to keep the results of the
+                       search; files not modified since the last search with the
+                       same labels will not be read again.
+
+    Returns a sorted list with the paths of the matching files.
+    """
+
+    if not compat_labels:
+        return []
+    compat_re = get_compatible_prop_re(tuple(compat_labels))
+    cache_key = hashlib.blake2b(compat_re.pattern.encode(), digest_size=8).hexdigest()
+    cache = _load_scan_cache(cache_path) if cache_path else {}
+    cached_results = cache.get(cache_key, {})
+
+    results = {}
+    compat_paths = []
+    for dirpath, _, filenames in os.walk(overlays_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            abs_path = os.path.abspath(path)
+            results[abs_path] = _match_overlay_file(
+                path, compat_re, cached_results.get(abs_path))
+            if results[abs_path][2]:
+                compat_paths.append(path)
+
+    if cache_path and results != cached_results:
+        cache[cache_key] = results
+        _save_scan_cache(cache_path, cache)
+
+    return sorted(compat_paths)
+
+
+def _match_overlay_file(path, compat_re, cached=None):
+    """Check whether the file at 'path' matches 'compat_re'.
+
+    :param cached: the entry of the scan cache for the file, if any; it is
+                   used (instead of reading the file) when still current.
+
+    Returns the entry of the scan cache for the file: [mtime, size, matched].
+    """
+    stat = os.stat(path)
+    if cached and cached[:2] == [stat.st_mtime_ns, stat.st_size]:
+        matched = cached[2]
+    else:
+        with open(path, "r", encoding="utf-8", errors="ignore") as srcf:
+            matched = bool(compat_re.search(srcf.read()))
+    return [stat.st_mtime_ns, stat.st_size, matched]
+
+
+def _load_scan_cache(cache_path):
+    """Load the scan cache; a missing or broken file is taken as an empty cache."""
+    try:
+        with open(cache_path, "r", encoding="utf-8") as cachef:
+            cache = json.load(cachef)
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def _save_scan_cache(cache_path, cache):
+    """Save the scan cache atomically; failing to do so is not an error."""
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=os.path.dirname(cache_path), delete=False) as cachef:
+            json.dump(cache, cachef)
+        os.replace(cachef.name, cache_path)
+    except OSError as exc:
+        log.debug(f"Could not save overlays scan cache: {exc}")
+
+
 def modify_dtb_by_overlays(source_dtb_path, source_dtob_paths, target_dtb_path):
     """Apply overlay blobs over device tree blob.
 
@@ -24,8 +24,8 @@ import paramiko
 
 from tcbuilder.backend.common import (get_rootfs_tarball, get_tar_compress_program_options,
                                       set_output_ownership, run_with_loading_animation,
-                                      get_tezi_image_version, DEFAULT_RAW_ROOTFS_LABEL,
-                                      RAW_PROP_TO_ARGNAME)
+                                      get_tezi_image_version, invalidate_rootfs_tarball_cache,
+                                      DEFAULT_RAW_ROOTFS_LABEL, RAW_PROP_TO_ARGNAME)
 from tcbuilder.backend import ostree
 from tcbuilder.errors import (TorizonCoreBuilderError, InvalidArgumentError, InvalidStateError)
 from tezi.image import ImageConfig, DEFAULT_IMAGE_JSON_FILENAME
@@ -159,10 +159,9 @@ def get_device_info(r_host, r_username, r_password, r_port):
 
 
 # pylint: disable=too-many-locals
-def download_tezi(r_host, r_username, r_password, r_port,
-                  tezi_dir, src_sysroot_dir, src_ostree_archive_dir):
+def get_tezi_image_url(r_host, r_username, r_password, r_port):
     """
-    Download appropriate Tezi Image based on target device.
+    Get the URL of the Tezi Image matching the one running on the target device.
     """
 
     version, hostname, container = get_device_info(r_host,
@@ -223,6 +222,22 @@ def download_tezi(r_host, r_username, r_password, r_port,
               prod, yocto, build_type, build_number, module_name, kernel_type,
               rt_flag, yocto_img_name, container, sem_ver, devel, date)
 
+    return url
+# pylint: enable=too-many-locals
+
+
+def download_tezi(r_host, r_username, r_password, r_port,
+                  tezi_dir, src_sysroot_dir, src_ostree_archive_dir, url=None):
+    """
+    Download appropriate Tezi Image based on target device.
+
+    :param url: URL of the image, as returned by `get_tezi_image_url()`; when not
+                passed it will be determined by querying the target device.
+    """
+
+    if url is None:
+        url = get_tezi_image_url(r_host, r_username, r_password, r_port)
+
     # Download and unpack tezi image
     log.info(f"Downloading image from: {url}\n")
     log.info("The download may take some time. Please wait...")
@@ -237,7 +252,6 @@ def download_tezi(r_host, r_username, r_password, r_port,
     set_output_ownership(download_file_cwd)
     import_local_image(download_file, tezi_dir,
                        src_sysroot_dir, src_ostree_archive_dir)
-# pylint: enable=too-many-locals
 
 
 def unpack_local_image(image_dir, sysroot_dir):
@@ -460,7 +474,8 @@ def prov_gen_provdata_tarball(output_dir, shared_data, online_data, hibernated):
                     if hibernated and isinstance(online_data_obj, dict):
                         log.info("Adding hibernated mode flag.")
                         online_data_obj['hibernated'] = True
-                        online_data_json = json.dumps(online_data_obj).encode("utf-8")
+                        online_data_json = json.dumps(
+                            online_data_obj, separators=(",", ":")).encode("utf-8")
 
                 except (binascii.Error, json.decoder.JSONDecodeError) as exc:
                     raise TorizonCoreBuilderError(
@@ -489,6 +504,7 @@ def prov_add_provdata_tarball(output_dir):
         [(PROV_DATA_FILENAME, "/ostree/deploy/torizon/var/sota/", True)],
         image_dir=output_dir, update_size=True, fail_src_present=True)
     config.save()
+    invalidate_rootfs_tarball_cache()
 
 
 def provision(input_dir, output_dir, shared_data, online_data, hibernated=False, force=False):
@@ -3,6 +3,8 @@
 Helper functions for commonly used OSTree functions.
 """
 
+import collections
+import functools
 import logging
 import os
 import re
@@ -10,8 +12,9 @@ import subprocess
 import traceback
 import threading
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import partial
-from http.server import SimpleHTTPRequestHandler, HTTPServer
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 
 from tcbuilder.errors import TorizonCoreBuilderError, PathNotExistError
 
@@ -26,12 +29,35 @@ log = logging.getLogger("torizon." + __name__)
 OSTREE_BASE_REF = "base"
 DEFAULT_SERVER_PORT = 8080
 
+# Refs generated by OSTree itself (e.g. by the "pull-local" command).
+OSTREE_AUTO_REF_RE = re.compile(r"ostree/[0-9]+/[0-9]+/[0-9]+")
+
+# Maximum number of local pulls running at the same time.
+MAX_PARALLEL_PULLS = 8
+
+# Maximum number of pulls from remote repositories running at the same time.
+MAX_PARALLEL_REMOTE_PULLS = 4
+
+# Whether libostree can pull from a local repository in-process; this is
+# detected by the first pull_local_refs() call rather than assumed from the
+# library version.
+_pull_local_in_process_works = True  # pylint: disable=invalid-name
+
+# Size of the chunks used when copying files out of a commit.
+COPY_CHUNK_SIZE = 1024 * 1024
+
 # Whiteout defines match what Containers are using:
 # https://github.com/opencontainers/image-spec/blob/v1.0.1/layer.md#whiteouts
 # this is from src/libostree/ostree-repo-checkout.c
 OSTREE_WHITEOUT_PREFIX = ".wh."
 OSTREE_OPAQUE_WHITEOUT_NAME = ".wh..wh..opq"
 
+# GLib.Variant objects are immutable: build the constant ones only once.
+REMOTE_ADD_OPTIONS = GLib.Variant("a{sv}", {
+    "gpg-verify": GLib.Variant("b", False)
+})
+EMPTY_OPTIONS = GLib.Variant("a{sv}", {})
+
 def open_ostree(ostree_dir):
     repo = OSTree.Repo.new(Gio.File.new_for_path(ostree_dir))
     if not repo.open(None):
@@ -98,13 +124,15 @@ def pull_remote(repo, name, remote, refs, token, progress=None):
     :param progress: Async progress handler
     """
 
-    options = GLib.Variant("a{sv}", {
-        "gpg-verify": GLib.Variant("b", False)
-    })
-
-    if not repo.remote_add(name, remote, options=options):
+    if not repo.remote_add(name, remote, options=REMOTE_ADD_OPTIONS):
         raise TorizonCoreBuilderError(f"Error adding remote {remote}.")
 
+    _pull_added_remote(repo, name, refs, token, progress)
+
+
+def _pull_added_remote(repo, name, refs, token, progress=None):
+    """Pull from a remote already added to the repo (see pull_remote())"""
+
     options = GLib.Variant("a{sv}", {
         "flags": GLib.Variant("i", OSTree.RepoPullFlags.MIRROR & OSTree.RepoPullFlags.TRUSTED_HTTP),
         "http-headers": GLib.Variant("a(ss)", [("Authorization", f"Bearer {token}")]),
@@ -118,6 +146,7 @@ def pull_remote(repo, name, remote, refs, token, progress=None):
         asyncprogress = None
 
     log.info("Pulling commits...")
+    invalidate_repo_caches()
     if not repo.pull_with_options(name, options, progress=asyncprogress):
         raise TorizonCoreBuilderError("Error pulling contents from remote repository.")
 
@@ -126,6 +155,57 @@ def pull_remote(repo, name, remote, refs, token, progress=None):
         asyncprogress.finish()
 
 
+def pull_remote_many(repopath, pulls, max_workers=MAX_PARALLEL_REMOTE_PULLS):
+    """
+    Function to pull OSTree from several remotes concurrently.
+
+    The remotes are added serially (they are all stored in the repo config
+    file); the pulls then run from a thread pool, each worker thread with its
+    own handle of the repository. Notice libostree already negotiates HTTP/2
+    by default where the server supports it.
+
+    :param repopath: Path of the repo to pull into.
+    :param pulls: Iterable of (name, remote, refs, token) tuples with the same
+                  meaning as the corresponding arguments of pull_remote().
+    :param max_workers: Maximum number of pulls running at the same time.
+    :raises:
+        TorizonCoreBuilderError: if adding any remote or any pull failed.
+    """
+    pulls = list(pulls)
+    if not pulls:
+        return
+
+    repo = open_ostree(repopath)
+    for name, remote, _refs, _token in pulls:
+        if not repo.remote_add(name, remote, options=REMOTE_ADD_OPTIONS):
+            raise TorizonCoreBuilderError(f"Error adding remote {remote}.")
+
+    local = threading.local()
+
+    def _pull(name, refs, token):
+        if not hasattr(local, "repo"):
+            local.repo = open_ostree(repopath)
+        _pull_added_remote(local.repo, name, refs, token)
+
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_pull, name, refs, token): remote
+                       for name, remote, refs, token in pulls}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except (TorizonCoreBuilderError, GLib.Error) as exc:
+                    errors.append(f"{futures[future]}: {exc}")
+    finally:
+        # Drop anything cached while the pulls were still updating the refs.
+        invalidate_repo_caches()
+
+    if errors:
+        raise TorizonCoreBuilderError(
+            "Error pulling contents from remote repositories:\n  " + "\n  ".join(errors))
+
+
 def generate_delta(repo, from_delta, to_delta):
     """
     Function to generate static delta.
@@ -139,21 +219,57 @@ def generate_delta(repo, from_delta, to_delta):
                                         from_delta,
                                         to_delta,
                                         None,
-                                        GLib.Variant("a{sv}", None),
+                                        EMPTY_OPTIONS,
                                         None)
 
     if not result:
         raise TorizonCoreBuilderError("Error generating static delta.")
 
 
-def pull_remote_ref(repo, uri, ref, remote=None, progress=None):
-    options = GLib.Variant("a{sv}", {
-        "gpg-verify": GLib.Variant("b", False)
-    })
+def generate_delta_many(repopath, pairs, max_workers=None):
+    """
+    Function to generate several static deltas concurrently.
+
+    Each worker thread opens its own handle of the repository since
+    OSTree.Repo objects should not be shared between threads.
 
+    :param repopath: Path of the static delta repo.
+    :param pairs: Iterable of (from_delta, to_delta) tuples of OSTree commits.
+    :param max_workers: Maximum number of deltas being generated at the same
+                        time (defaults to the number of CPUs).
+    :raises:
+        TorizonCoreBuilderError: if generating any of the deltas failed.
+    """
+    pairs = list(pairs)
+    if not pairs:
+        return
+
+    local = threading.local()
+
+    def _generate(pair):
+        if not hasattr(local, "repo"):
+            local.repo = open_ostree(repopath)
+        generate_delta(local.repo, *pair)
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = {executor.submit(_generate, pair): pair for pair in pairs}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (TorizonCoreBuilderError, GLib.Error) as exc:
+                from_delta, to_delta = futures[future]
+                errors.append(f"{from_delta} -> {to_delta}: {exc}")
+
+    if errors:
+        raise TorizonCoreBuilderError(
+            "Error generating static deltas:\n  " + "\n  ".join(errors))
+
+
+def pull_remote_ref(repo, uri, ref, remote=None, progress=None):
     log.debug(f"Pulling remote {uri} reference {ref}")
 
-    if not repo.remote_add("origin", remote, options=options):
+    if not repo.remote_add("origin", remote, options=REMOTE_ADD_OPTIONS):
         raise TorizonCoreBuilderError(f"Error adding remote {remote}.")
 
     # ostree --repo=toradex-os-tree pull origin torizon/torizon-core-docker --depth=0
@@ -170,6 +286,7 @@ def pull_remote_ref(repo, uri, ref, remote=None, progress=None):
     else:
         asyncprogress = None
 
+    invalidate_repo_caches()
     if not repo.pull_with_options("origin", options, progress=asyncprogress):
         raise TorizonCoreBuilderError("Error pulling contents from local repository.")
 
@@ -184,15 +301,71 @@ def get_reference_dict(repopath, base_csum=None):
         A dict with the reference as key and the checksum as value.
         e.g: {'base': <checksum>}
     """
+    # Hand out a copy so that callers may modify it.
+    return dict(_get_reference_items(repopath, base_csum))
+
+
+@functools.lru_cache(maxsize=32)
+def _get_reference_items(repopath, base_csum):
+    """Cached implementation of get_reference_dict() returning a tuple of items
+
+    The cache is cleared by invalidate_repo_caches().
+    """
     ref_dict = {} if base_csum is None else {OSTREE_BASE_REF: base_csum}
     sysroot_repo = open_ostree(repopath)
-    for ref_name, ref_csum in sysroot_repo.list_refs().out_all_refs.items():
-        # Filter out the remote and the OSTree generated ref
-        if re.match(r"ostree/[0-9]+/[0-9]+/[0-9]+", ref_name) is None:
-            ref_name = ref_name.split(":", 1)[-1].lstrip()
-            ref_dict[ref_name] = ref_csum
+    is_auto_ref = OSTREE_AUTO_REF_RE.match
+    # Filter out the OSTree generated refs and the remote part of the names.
+    ref_dict.update({
+        (ref_name.partition(":")[2].lstrip() if ":" in ref_name else ref_name): ref_csum
+        for ref_name, ref_csum in sysroot_repo.list_refs().out_all_refs.items()
+        if is_auto_ref(ref_name) is None
+    })
+
+    return tuple(ref_dict.items())
+
+
+def invalidate_repo_caches():
+    """Forget what is cached about the contents of the OSTree repositories
+
+    This must be called by every function changing the refs of a repository.
+    """
+    _get_reference_items.cache_clear()
+    _read_commit_root.cache_clear()
 
-    return ref_dict
+
+def _set_refs(repo, refs):
+    """Set the given references (dict of name to checksum) in the repo"""
+    invalidate_repo_caches()
+    # Write all refs in a single transaction (rather than syncing each one).
+    repo.prepare_transaction(None)
+    try:
+        for ref_name, ref_csum in refs.items():
+            # Note: In theory we can do this with two options in one go, but that seems
+            # to validate ref-bindings... (has probably something to do with Collection IDs
+            # etc..)
+            #"refs": GLib.Variant.new_strv(["base"]),
+            #"override-commit-ids": GLib.Variant.new_strv([ref]),
+            repo.transaction_set_collection_ref(
+                OSTree.CollectionRef.new(None, ref_name), ref_csum)
+        repo.commit_transaction(None)
+    except Exception:
+        repo.abort_transaction(None)
+        raise
+
+
+def _pull_local_in_process(repo, repopath, refs, remote=None):
+    """Pull all commits of `refs` from local repository in a single libostree call"""
+    log.debug(f"Pulling from local repository {repopath} commit checksums {list(refs.values())}")
+    options = {
+        "refs": GLib.Variant.new_strv(list(refs.values())),
+        "depth": GLib.Variant("i", 0),
+    }
+    if remote:
+        options["override-remote-name"] = GLib.Variant("s", remote)
+    if not repo.pull_with_options("file://" + repopath, GLib.Variant("a{sv}", options)):
+        raise TorizonCoreBuilderError(
+            f"Error pulling contents from local repository {repopath}.")
+    _set_refs(repo, refs)
 
 
 def pull_local_refs(repo: OSTree.Repo, repopath: str, refs: str, remote=None):
@@ -204,26 +377,41 @@ def pull_local_refs(repo: OSTree.Repo, repopath: str, refs: str, remote=None):
     :param refs: Remote reference to pull.
     :param remote: Remote name used in refspec.
     """
-    # With Bullseye's ostree version 2020.7, the following snippet fails with:
-    # gi.repository.GLib.GError: g-io-error-quark: Remote "torizon" not found (1)
-    #
-    #    options = GLib.Variant("a{sv}", {
-    #        "refs": GLib.Variant.new_strv([csum]),
-    #        "depth": GLib.Variant("i", 0),
-    #        "override-remote-name": GLib.Variant('s', remote),
-    #    })
-    #    if not repo.pull_with_options("file://" + repopath, options):
-    #        raise TorizonCoreBuilderError(
-    #            f"Error pulling contents from local repository {repopath}.")
-    #
-    # Work around by employing the ostree CLI instead.
-    repo_fd = repo.get_dfd()
-    repo_str = os.readlink(f"/proc/self/fd/{repo_fd}")
-
+    global _pull_local_in_process_works  # pylint: disable=global-statement
+
+    if refs and _pull_local_in_process_works:
+        try:
+            _pull_local_in_process(repo, repopath, refs, remote)
+            return
+        except GLib.Error as exc:
+            # With Bullseye's ostree version 2020.7 the in-process pull fails with:
+            # gi.repository.GLib.GError: g-io-error-quark: Remote "torizon" not found (1)
+            #
+            # Work around by employing the ostree CLI instead (from now on).
+            log.debug(f"In-process pull from {repopath} failed ({exc}); using the ostree CLI")
+            _pull_local_in_process_works = False
+
+    repo_str = os.path.abspath(repo.get_path().get_path())
+
+    def _reap(running):
+        # Only forget about the oldest process once it has finished.
+        proc = running[0]
+        _stdout, stderr = proc.communicate()
+        running.popleft()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=stderr)
+
+    # The pulls are independent from each other: keep a bounded number of
+    # processes running and reap them in the order they were started.
+    running = collections.deque()
     try:
-        for ref_name, ref_csum in refs.items():
+        for ref_csum in refs.values():
+            if len(running) >= MAX_PARALLEL_PULLS:
+                _reap(running)
             log.debug(f"Pulling from local repository {repopath} commit checksum {ref_csum}")
-            subprocess.run(
+            # pylint: disable=consider-using-with
+            # (the processes are waited for in the finally clause below)
+            running.append(subprocess.Popen(
                 [arg for arg in [
                     "ostree",
                     "pull-local",
@@ -231,48 +419,73 @@ def pull_local_refs(repo: OSTree.Repo, repopath: str, refs: str, remote=None):
                     f"--remote={remote}" if remote else None,
                     repopath,
                     ref_csum] if arg],
-                check=True)
-            repo.reload_config()
-            # Note: In theory we can do this with two options in one go, but that seems
-            # to validate ref-bindings... (has probably something to do with Collection IDs etc..)
-            #"refs": GLib.Variant.new_strv(["base"]),
-            #"override-commit-ids": GLib.Variant.new_strv([ref]),
-            repo.set_collection_ref_immediate(OSTree.CollectionRef.new(None, ref_name), ref_csum)
+                stderr=subprocess.PIPE, text=True))
+            # pylint: enable=consider-using-with
+        while running:
+            _reap(running)
     except subprocess.CalledProcessError as exc:
         logging.error(traceback.format_exc())
+        if exc.stderr:
+            logging.error(exc.stderr.rstrip())
         raise TorizonCoreBuilderError(
             f"Error pulling contents from local repository {repopath}.") from exc
+    finally:
+        # Do not leave processes behind on errors (including interruptions).
+        for proc in running:
+            proc.terminate()
+        for proc in running:
+            proc.communicate()
+
+    # The repo was changed by the ostree processes: reload it before setting the refs.
+    repo.reload_config()
+    _set_refs(repo, refs)
 
 
+GIO_FILE_TYPE_NAMES = {
+    Gio.FileType.DIRECTORY: 'directory',
+    Gio.FileType.MOUNTABLE: 'mountable',
+    Gio.FileType.REGULAR: 'regular',
+    Gio.FileType.SHORTCUT: 'shortcut',
+    Gio.FileType.SPECIAL: 'special',
+    Gio.FileType.SYMBOLIC_LINK: 'symbolic_link',
+    Gio.FileType.UNKNOWN: 'unknown'
+}
+
 
 def _convert_gio_file_type(gio_file_type):
-    res = None
-    if gio_file_type == Gio.FileType.DIRECTORY:
-        res = 'directory'
-    elif gio_file_type == Gio.FileType.MOUNTABLE:
-        res = 'mountable'
-    elif gio_file_type == Gio.FileType.REGULAR:
-        res = 'regular'
-    elif gio_file_type == Gio.FileType.SHORTCUT:
-        res = 'shortcut'
-    elif gio_file_type == Gio.FileType.SPECIAL:
-        res = 'special'
-    elif gio_file_type == Gio.FileType.SYMBOLIC_LINK:
-        res = 'symbolic_link'
-    elif gio_file_type == Gio.FileType.UNKNOWN:
-        res = 'unknown'
-    else:
-        raise TorizonCoreBuilderError(f"Unknown gio filetype {gio_file_type}")
-    return res
+    try:
+        return GIO_FILE_TYPE_NAMES[gio_file_type]
+    except KeyError:
+        raise TorizonCoreBuilderError(f"Unknown gio filetype {gio_file_type}") from None
 
 
-def check_existance(repo, commit, path):
-    path = os.path.realpath(path)
+@functools.lru_cache(maxsize=8)
+def _read_commit_root(repo, commit):
+    """Get the root directory (Gio.File) of a commit
 
+    The roots are cached per repository object and commit (checksum or ref
+    name); the cache is bounded so that it only keeps a few repository objects
+    alive and it is cleared by invalidate_repo_caches() since a ref name may
+    point to another commit after the refs are changed.
+    """
     ret, root, _commit = repo.read_commit(commit)
     if not ret:
         raise TorizonCoreBuilderError(f"Error couldn't reat commit: {commit}")
+    return root
+
+
+def _normalize_commit_path(path):
+    """Normalize a path inside a commit (no trailing "/" which confuses ostree)
 
+    Unlike os.path.realpath() this does not look at the host filesystem.
+    """
+    return os.path.normpath(path).rstrip("/") or "/"
+
+
+def check_existance(repo, commit, path):
+    path = _normalize_commit_path(path)
+
+    root = _read_commit_root(repo, commit)
     sub_path = root.resolve_relative_path(path)
     return sub_path.query_exists()
 
@@ -294,12 +507,9 @@ def ls(repo, path, commit):
             PathNotExistError - if path does not exist
     """
     # Make sure we don't end the path with / because this confuses ostree
-    path = os.path.realpath(path)
-
-    ret, root, _commit = repo.read_commit(commit)
-    if not ret:
-        raise TorizonCoreBuilderError(f"Error couldn't reat commit: {commit}")
+    path = _normalize_commit_path(path)
 
+    root = _read_commit_root(repo, commit)
     sub_path = root.resolve_relative_path(path)
     if sub_path.query_exists():
         file_list = sub_path.enumerate_children(
@@ -327,22 +537,34 @@ def get_kernel_version(repo, commit):
 
     kernel_version = ""
 
-    module_files = ls(repo, "/usr/lib/modules", commit)
-    module_dirs = filter(lambda file: file["type"] == "directory",
-                         module_files)
+    # Read the commit only once and walk its tree directly.
+    root = _read_commit_root(repo, commit)
+    modules_dir = root.resolve_relative_path("/usr/lib/modules")
+    try:
+        module_files = modules_dir.enumerate_children(
+            "standard::name,standard::type", Gio.FileQueryInfoFlags.NOFOLLOW_SYMLINKS, None)
+    except GLib.Error as exc:
+        if exc.matches(Gio.io_error_quark(), Gio.IOErrorEnum.NOT_FOUND):
+            raise PathNotExistError("path /usr/lib/modules does not exist") from exc
+        raise
 
     # This is a similar approach to what OSTree does in the deploy command.
     # It searches for the directory under /usr/lib/modules/<kver> which
     # contains a vmlinuz file.
-    for module_dir in module_dirs:
-        directory_name = module_dir["name"]
-
-        # Check if the directory contains a vmlinuz image if so it is our
-        # kernel directory
-        files = ls(repo, f"/usr/lib/modules/{directory_name}", commit)
-        if any(file for file in files if file["name"] == "vmlinuz"):
-            kernel_version = directory_name
-            break
+    try:
+        for module_file in module_files:
+            if module_file.get_file_type() != Gio.FileType.DIRECTORY:
+                continue
+            directory_name = module_file.get_name()
+
+            # Check if the directory contains a vmlinuz image if so it is our
+            # kernel directory (usually the first and only one).
+            vmlinuz = modules_dir.get_child(directory_name).get_child("vmlinuz")
+            if vmlinuz.query_exists():
+                kernel_version = directory_name
+                break
+    finally:
+        module_files.close(None)
 
     return kernel_version
 
@@ -358,30 +580,45 @@ def copy_file(repo, commit, input_file, output_file):
             TorizonCoreBuilderError - if commit does not exist
     """
 
-    # Make sure we don't end the path with / because this confuses ostree
-    ret, root, _commit = repo.read_commit(commit)
-    if not ret:
-        raise TorizonCoreBuilderError(f"Can not read commit: {commit}")
-
+    root = _read_commit_root(repo, commit)
     input_stream = root.resolve_relative_path(input_file).read()
 
-    output_stream = Gio.File.new_for_path(output_file).create(
-        Gio.FileCreateFlags.NONE, None)
-    if not output_stream:
-        raise TorizonCoreBuilderError(f"Can not create file {output_file}")
-
-    # Move input to output stream
-    output_stream.splice(
-        input_stream, Gio.OutputStreamSpliceFlags.CLOSE_SOURCE, None)
+    # Move input to output file in large chunks (splice() would use 8 KiB).
+    try:
+        with open(output_file, "xb") as output:
+            while True:
+                chunk = input_stream.read_bytes(COPY_CHUNK_SIZE, None).get_data()
+                if not chunk:
+                    break
+                output.write(chunk)
+    except OSError as exc:
+        raise TorizonCoreBuilderError(f"Can not create file {output_file}") from exc
+    finally:
+        input_stream.close(None)
 
 
 class TCBuilderHTTPRequestHandler(SimpleHTTPRequestHandler):
     """SimpleHTTPRequestHandler which makes use of logging framework"""
 
+    # Do not delay the many small responses (objects) OSTree asks for.
+    disable_nagle_algorithm = True
+    # Keep connections alive across requests (all responses carry a
+    # Content-Length, as required for that).
+    protocol_version = "HTTP/1.1"
+
     def __init__(self, *args, **kwargs):
         self.log = logging.getLogger("torizon." + __name__)
         super().__init__(*args, **kwargs)
 
+    def copyfile(self, source, outputfile):
+        """Send file contents with sendfile() (by the kernel) when possible
+
+        socket.sendfile() falls back to plain reads and sends when the source
+        is not a regular file (e.g. directory listings).
+        """
+        outputfile.flush()
+        self.connection.sendfile(source)
+
     #pylint: disable=redefined-builtin,logging-not-lazy
     def log_message(self, format, *args):
         self.log.debug(format % args)
@@ -399,7 +636,11 @@ class HTTPThread(threading.Thread):
         # From what I understand, this creates a __init__ function with the
         # directory argument already set. Nice hack!
         handler_init = partial(TCBuilderHTTPRequestHandler, directory=directory)
-        self.http_server = HTTPServer((host, port), handler_init)
+        # Serve the concurrent requests of OSTree clients in parallel.
+        self.http_server = ThreadingHTTPServer((host, port), handler_init)
+        self.http_server.daemon_threads = True
+        # Bound address; also available after the server is shut down.
+        self._server_address = self.http_server.server_address
 
     def run(self):
         self.http_server.serve_forever()
@@ -411,11 +652,11 @@ class HTTPThread(threading.Thread):
 
     @property
     def server_port(self):
-        return self.http_server.server_port
+        return self._server_address[1]
 
     @property
     def server_address(self):
-        return self.http_server.server_address
+        return self._server_address
 
 
 def serve_ostree_start(ostree_dir, host="", port=DEFAULT_SERVER_PORT):
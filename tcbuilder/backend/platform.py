@@ -187,6 +187,9 @@ def do_fetch_ostree_target(target, sha256, ostree_url, images_dir, access_token=
         log.debug(called_process_error.stderr)
         log.debug("Could not create ref according to Uptane target name (non-fatal)")
 
+    # The refs were changed behind the back of the ostree module.
+    ostree.invalidate_repo_caches()
+
     # Remove remote.
     subprocess.run(
         ["ostree", "remote", "delete", remote_name, "--repo", repo_dir],
@@ -145,6 +145,7 @@ def commit_changes(repo, ref, changes_dirs, branch_name,
 
     repo.transaction_set_ref(None, branch_name, commit)
     result, stats = repo.commit_transaction()
+    ostree.invalidate_repo_caches()
     if not result:
         raise TorizonCoreBuilderError("Commit failed.")
 
@@ -6,6 +6,7 @@ Allows to bundle a Toradex Easy Installer images with a set of containers.
 import argparse
 import logging
 import os
+import re
 import shutil
 
 from tcbuilder.backend import common
@@ -16,10 +17,13 @@ from tcbuilder.backend.registryops import RegistryOperations
 
 log = logging.getLogger("torizon." + __name__)
 
+# Size of a tmpfs as accepted by its "size" mount option (e.g. "512m" or "50%").
+TMPFS_SIZE_RE = re.compile(r"[1-9][0-9]*[kKmMgGtTpPeE%]?")
+
 
 # pylint: disable=too-many-arguments
 def bundle(bundle_dir, compose_file, force=False, keep_double_dollar_sign=False,
-           platform=None, dind_params=None):
+           platform=None, dind_params=None, tmpfs_size=None, registry_cache=False):
     """Main handler of the bundle command (CLI layer)
 
     :param bundle_dir: Name of bundle directory (that will be created in the
@@ -33,6 +37,10 @@ def bundle(bundle_dir, compose_file, force=False, keep_double_dollar_sign=False,
     :param platform: Default platform to use when fetching multi-platform
                      container images.
     :param dind_params: Extra parameters to pass to Docker-in-Docker (list).
+    :param tmpfs_size: Size of the tmpfs where Docker-in-Docker will store the
+                       container images (None to store them on disk).
+    :param registry_cache: Whether to fetch Docker Hub images through a local
+                           pull-through cache that is kept between runs.
     """
 
     if os.path.exists(bundle_dir):
@@ -54,7 +62,9 @@ def bundle(bundle_dir, compose_file, force=False, keep_double_dollar_sign=False,
         output_filename=f"{common.DOCKER_BUNDLE_TARNAME}.xz",
         keep_double_dollar_sign=keep_double_dollar_sign,
         platform=platform,
-        dind_params=dind_params)
+        dind_params=dind_params,
+        tmpfs_size=tmpfs_size,
+        registry_cache=registry_cache)
 
     log.info(f"Successfully created Docker Container bundle in \"{bundle_dir}\"!")
 
@@ -87,6 +97,12 @@ def do_bundle(args):
         raise InvalidArgumentError(
             "Error: the COMPOSE_FILE positional argument is required.")
 
+    if args.tmpfs_size is not None and not TMPFS_SIZE_RE.fullmatch(args.tmpfs_size):
+        raise InvalidArgumentError(
+            f"Error: invalid tmpfs size '{args.tmpfs_size}'; please pass a number "
+            "optionally followed by one of the suffixes k, m, g, t, p or e (in any "
+            "case) or by % for a share of the RAM (e.g. 8g).")
+
     # Build list of logins:
     logins = []
     if args.main_login:
@@ -103,7 +119,9 @@ def do_bundle(args):
            force=args.force,
            keep_double_dollar_sign=args.keep_double_dollar_sign,
            platform=args.platform,
-           dind_params=args.dind_params)
+           dind_params=args.dind_params,
+           tmpfs_size=args.tmpfs_size,
+           registry_cache=args.registry_cache)
 
     common.set_output_ownership(args.bundle_directory)
 
@@ -159,6 +177,19 @@ def init_parser(subparsers):
         "--keep-double-dollar-sign", dest="keep_double_dollar_sign",
         default=False, action="store_true",
         help="Don't replace '$$' with '$' when parsing string values of the input compose file.")
+    subparser.add_argument(
+        "--tmpfs-size", dest="tmpfs_size", metavar="SIZE",
+        help=("Keep the container images being fetched in a RAM-backed filesystem "
+              "(tmpfs) of the given size (e.g. 8g) rather than on disk while "
+              "creating the bundle; the size must fit all images."))
+    subparser.add_argument(
+        "--registry-cache", dest="registry_cache",
+        default=False, action="store_true",
+        help=("Fetch Docker Hub images through a pull-through cache container "
+              "(tcb-registry-cache) which is left running, together with its "
+              "volume, to speed up subsequent runs. To get rid of them, run "
+              "'docker rm -f tcb-registry-cache' and "
+              "'docker volume rm tcb-registry-cache'."))
     common.add_common_registry_arguments(subparser)
     add_dind_param_arguments(subparser)
 
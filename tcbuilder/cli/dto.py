@@ -2,12 +2,13 @@
 
 import logging
 import os
-import shlex
+import re
 import shutil
-import subprocess
 import sys
 import tempfile
 
+import libfdt
+
 from tcbuilder.backend import dt, dto, common
 from tcbuilder.backend.common import images_unpack_executed, unpacked_image_type
 
@@ -20,6 +21,10 @@ from tcbuilder.errors import InvalidDataError
 
 log = logging.getLogger("torizon." + __name__)
 
+# First "compatible = ...;" property of a device tree source and the strings within it.
+DTS_COMPATIBLE_RE = re.compile(r'^[ \t]*compatible\s*=([^;]*);', re.MULTILINE)
+DTS_STRING_RE = re.compile(r'"([^"]*)"')
+
 # Dear maintainer, the following code employs these abbreviations as pieces of variable names:
 # - dts: device tree source
 # - dtb: device tree blob
@@ -32,7 +37,41 @@ log = logging.getLogger("torizon." + __name__)
 # - target: functional output artifact in filesystem
 
 
-# pylint: disable=too-many-locals
+def _list_dtbs(dtb_dir):
+    '''Return the (sorted) base names of the device tree blobs in 'dtb_dir'.'''
+    with os.scandir(dtb_dir) as entries:
+        return sorted(entry.name for entry in entries
+                      if entry.name.endswith(".dtb") and entry.is_file())
+
+
+def _check_unpacked(storage_dir):
+    '''Check an image supported by the dto commands is unpacked in 'storage_dir'.'''
+    images_unpack_executed(storage_dir)
+    if unpacked_image_type(storage_dir) == "raw":
+        raise InvalidDataError("dto commands are not supported for WIC/raw images. "
+                               "Aborting.")
+
+
+def _write_if_changed(path, content):
+    '''Write 'content' into file 'path' (creating its directory) unless it is already there.'''
+    try:
+        with open(path, "r") as file:
+            if file.read() == content:
+                return
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(content)
+
+
+def get_dts_compatible_labels(dts_text):
+    '''Return the labels of the first "compatible" property in a device tree source.'''
+    match = DTS_COMPATIBLE_RE.search(dts_text)
+    if not match:
+        return []
+    return DTS_STRING_RE.findall(match.group(1))
+
+
 def dto_apply(dtos_path, dtb_path, include_dirs, storage_dir,
               allow_reapply=False, test_apply=True):
     '''Execute most of the work of 'dto apply' command.
@@ -48,95 +87,163 @@ def dto_apply(dtos_path, dtb_path, include_dirs, storage_dir,
                        errors.
     '''
 
-    images_unpack_executed(storage_dir)
-    if unpacked_image_type(storage_dir) == "raw":
-        raise InvalidDataError("dto commands are not supported for WIC/raw images. "
-                               "Aborting.")
+    dto_apply_batch([dtos_path], dtb_path, include_dirs, storage_dir,
+                    allow_reapply=allow_reapply, test_apply=test_apply)
+
+
+def dto_apply_batch(dtos_paths, dtb_path, include_dirs, storage_dir,
+                    allow_reapply=False, test_apply=True):
+    '''Apply multiple device tree overlays in one go.
+
+    This has the same effect as calling `dto_apply()` for each element of `dtos_paths`
+    in order, but the device tree is test applied only once (against all overlays)
+    and overlays.txt is written only once.
+
+    :param dtos_paths: list of full paths to the source device-tree overlay files to be
+                       applied; the other parameters are the same as in `dto_apply()`.
+    '''
+
+    _check_unpacked(storage_dir)
+    dtb_changes_dir = dt.get_dtb_changes_dir(storage_dir)
 
     applied_overlay_basenames = dto.get_applied_overlays_base_names(storage_dir)
-    dtob_target_basename = os.path.splitext(os.path.basename(dtos_path))[0] + ".dtbo"
+    applied_overlay_set = set(applied_overlay_basenames)
+
+    # Validate the whole batch before anything is written into the storage.
+    dtob_target_basenames = []
+    for dtos_path in dtos_paths:
+        dtob_target_basename = os.path.splitext(os.path.basename(dtos_path))[0] + ".dtbo"
+
+        # Detect a redundant overlay application.
+        if not allow_reapply:
+            if (dtob_target_basename in applied_overlay_set or
+                    dtob_target_basename in dtob_target_basenames):
+                log.error(f"error: overlay {dtob_target_basename} is already applied.")
+                sys.exit(1)
+        dtob_target_basenames.append(dtob_target_basename)
 
-    # Detect a redundant overlay application.
-    if not allow_reapply:
-        if dtob_target_basename in applied_overlay_basenames:
-            log.error(f"error: overlay {dtob_target_basename} is already applied.")
-            sys.exit(1)
+    if test_apply:
+        dtb_path = _get_test_dtb_path(dtb_path, storage_dir)
+
+    dtob_tmp_paths = {}
+    # Overlays are compiled inside the storage so that deploying them is just a rename;
+    # temporary files are removed along with the directory, also on failure.
+    with tempfile.TemporaryDirectory(prefix="dto-apply-",
+                                     dir=common.get_storage_tmp_dir(storage_dir)) as tmp_dir:
+        for dtos_path, dtob_target_basename in zip(dtos_paths, dtob_target_basenames):
+            # In case the user is reapplying an overlay within the batch, only the last
+            # application will take effect (and it goes to the end of the list).
+            dtob_tmp_paths.pop(dtob_target_basename, None)
+            dtob_tmp_paths[dtob_target_basename] = f"{tmp_dir}/{dtob_target_basename}"
+            _compile_overlay(dtos_path, include_dirs, dtob_tmp_paths[dtob_target_basename])
+
+        # Reapplied overlays are removed from their current position in the list so that
+        # only the last application takes effect.
+        overlay_basenames = [basename for basename in applied_overlay_basenames
+                             if basename not in dtob_tmp_paths]
+        overlay_basenames.extend(dtob_tmp_paths)
+
+        # Test apply the overlays against the current device tree and other applied overlays.
+        if test_apply:
+            _test_apply_overlays(dtb_path, overlay_basenames, dtob_tmp_paths, storage_dir,
+                                 f"{tmp_dir}/test.dtb")
+
+        _install_overlays(overlay_basenames, dtob_tmp_paths, dtb_changes_dir)
+
+    # All set :-)
+    for dtob_target_basename in dtob_tmp_paths:
+        log.info(f"Overlay {dtob_target_basename} successfully applied.")
 
-    # In case the user is reapplying an overlay we remove it from the current list
-    # to ensure only the last application will take effect.
-    if dtob_target_basename in applied_overlay_basenames:
-        applied_overlay_basenames.remove(dtob_target_basename)
 
-    # Compile the overlay.
-    with tempfile.NamedTemporaryFile(delete=False) as tmpf:
-        dtob_tmp_path = tmpf.name
+def _compile_overlay(dtos_path, include_dirs, dtob_tmp_path):
+    '''Compile an overlay into the temporary file 'dtob_tmp_path'.'''
+
     if not dt.build_dts(dtos_path, include_dirs, dtob_tmp_path):
         log.error(f"error: cannot apply {dtos_path}.")
         sys.exit(1)
 
-    # Test apply the overlay against the current device tree and other applied overlays.
-    if test_apply:
-        if dtb_path:
-            # User has provided the basename of a device tree blob of the base image.
-            (any_dtb_path, _) = dt.get_current_dtb_path(storage_dir)
-            dtb_path = os.path.join(os.path.dirname(any_dtb_path), dtb_path)
-        else:
-            # Use the current device tree blob.
-            (dtb_path, is_dtb_exact) = dt.get_current_dtb_path(storage_dir)
-            if not is_dtb_exact:
-                log.error("error: could not find the device tree to check the overlay against.")
-                log.error("Please use --device-tree to pass one of the device trees below or use "
-                          "--force to bypass checking:")
-                dtb_list = subprocess.check_output(
-                    ["find", os.path.dirname(dtb_path), "-maxdepth", "1", "-type", "f",
-                     "-name", "*.dtb", "-printf", "- %f\\n"],
-                    text=True).rstrip()
-                log.error(dtb_list)
-                sys.exit(1)
 
-        applied_overlay_paths = \
-            dto.get_applied_overlay_paths(storage_dir, base_names=applied_overlay_basenames)
-        with tempfile.NamedTemporaryFile(delete=False) as tmpf:
-            dtb_tmp_path = tmpf.name
-        if not dto.modify_dtb_by_overlays(dtb_path,
-                                          applied_overlay_paths + [dtob_tmp_path], dtb_tmp_path):
-            log.error(f"error: overlay '{dtos_path}' is not applicable.")
+def _get_test_dtb_path(dtb_path, storage_dir):
+    '''Get the full path to the device tree blob where to test apply overlays.
+
+    :param dtb_path: the basename of a device tree blob of the base image, or None to use
+                     the current device tree blob.
+    '''
+
+    if dtb_path:
+        # User has provided the basename of a device tree blob of the base image.
+        (any_dtb_path, _) = dt.get_current_dtb_path(storage_dir)
+        dtb_path = os.path.join(os.path.dirname(any_dtb_path), dtb_path)
+    else:
+        # Use the current device tree blob.
+        (dtb_path, is_dtb_exact) = dt.get_current_dtb_path(storage_dir)
+        if not is_dtb_exact:
+            log.error("error: could not find the device tree to check the overlay against.")
+            log.error("Please use --device-tree to pass one of the device trees below or use "
+                      "--force to bypass checking:")
+            for dtb_basename in _list_dtbs(os.path.dirname(dtb_path)):
+                log.error(f"- {dtb_basename}")
             sys.exit(1)
-        log.info(f"'{dtob_target_basename}' can successfully modify the device "
-                 f"tree '{os.path.basename(dtb_path)}'.")
+    return dtb_path
 
-    # Deploy the device tree overlay blob.
-    dt_changes_dir = dt.get_dt_changes_dir(storage_dir)
-    dtob_target_dir = os.path.join(
-        dt_changes_dir, dt.get_dtb_kernel_subdir(storage_dir), "overlays")
-    os.makedirs(dtob_target_dir, exist_ok=True)
-    dtob_target_path = os.path.join(dtob_target_dir, dtob_target_basename)
-    shutil.move(dtob_tmp_path, dtob_target_path)
 
-    # Deploy the enablement of the device tree overlay blob.
-    new_overlay_basenames = applied_overlay_basenames + [dtob_target_basename]
-    overlays_txt_target_path = \
-        os.path.join(dt_changes_dir, dt.get_dtb_kernel_subdir(storage_dir), "overlays.txt")
-    with open(overlays_txt_target_path, "w") as ovlf:
-        ovlf.write("fdt_overlays=" + " ".join(new_overlay_basenames) + "\n")
+def _test_apply_overlays(dtb_path, overlay_basenames, dtob_tmp_paths, storage_dir,
+                         dtb_tmp_path):
+    '''Check the overlays in 'overlay_basenames' can all be applied over the device tree.
 
-    # All set :-)
-    log.info(f"Overlay {dtob_target_basename} successfully applied.")
+    Overlays found in the dictionary `dtob_tmp_paths` (mapping base names to paths) are the
+    ones being applied; the others are taken from the currently applied ones. The resulting
+    device tree is written to the temporary file 'dtb_tmp_path'.
 
-# pylint: enable=too-many-locals
+    :param dtb_path: the full path returned by `_get_test_dtb_path()`.
+    '''
 
+    dtob_paths = [dtob_tmp_paths.get(basename) or dto.find_path_to_overlay(storage_dir, basename)
+                  for basename in overlay_basenames]
+    new_basenames = ", ".join(f"'{basename}'" for basename in dtob_tmp_paths)
+    if not dto.modify_dtb_by_overlays(dtb_path, dtob_paths, dtb_tmp_path):
+        log.error(f"error: overlay(s) {new_basenames} not applicable.")
+        sys.exit(1)
+    log.info(f"{new_basenames} can successfully modify the device "
+             f"tree '{os.path.basename(dtb_path)}'.")
 
-def do_dto_apply(args):
-    '''Perform the 'dto apply' command.'''
 
-    # Sanity check parameters.
+def _install_overlays(overlay_basenames, dtob_tmp_paths, dtb_changes_dir):
+    '''Deploy the compiled overlay blobs and enable 'overlay_basenames' in overlays.txt.
+
+    :param dtb_changes_dir: the directory returned by `dt.get_dtb_changes_dir()`.
+    '''
+
+    # Deploy the device tree overlay blobs (which were compiled into the same filesystem).
+    dtob_target_dir = f"{dtb_changes_dir}/overlays"
+    os.makedirs(dtob_target_dir, exist_ok=True)
+    for dtob_target_basename, dtob_tmp_path in dtob_tmp_paths.items():
+        dtob_target_path = f"{dtob_target_dir}/{dtob_target_basename}"
+        os.replace(dtob_tmp_path, dtob_target_path)
+
+    # Deploy the enablement of the device tree overlay blobs.
+    overlays_txt_target_path = f"{dtb_changes_dir}/overlays.txt"
+    _write_if_changed(overlays_txt_target_path,
+                      "fdt_overlays=" + " ".join(overlay_basenames) + "\n")
+
+
+def _prepare_apply_args(args):
+    '''Set defaults and warn about the arguments shared by 'dto apply' and 'dto deploy'.'''
+
     if not args.include_dirs:
         args.include_dirs = ["device-trees/include"]
-    assert args.dtos_path, "panic: missing overlay source parameter"
 
     if args.force:
         log.info("warning: --force was used, bypassing checking overlays against the device tree.")
 
+
+def do_dto_apply(args):
+    '''Perform the 'dto apply' command.'''
+
+    # Sanity check parameters.
+    assert args.dtos_path, "panic: missing overlay source parameter"
+    _prepare_apply_args(args)
+
     dto_apply(dtos_path=args.dtos_path,
               dtb_path=args.device_tree,
               include_dirs=args.include_dirs,
@@ -162,10 +269,7 @@ def do_dto_list(args):
                   "tree binary to --device-tree.")
         sys.exit(1)
 
-    images_unpack_executed(args.storage_directory)
-    if unpacked_image_type(args.storage_directory) == "raw":
-        raise InvalidDataError("dto commands are not supported for WIC/raw images. "
-                               "Aborting.")
+    _check_unpacked(args.storage_directory)
 
     # Find a device tree to check overlay compatibility against.
     dtb_path = args.device_tree
@@ -179,67 +283,42 @@ def do_dto_list(args):
         (dtb_path, is_dtb_exact) = dt.get_current_dtb_path(args.storage_directory)
     if not is_dtb_exact and not args.device_tree:
         log.error("Could not determine default device tree.")
-        dtb_list = subprocess.check_output(
-            ["find", os.path.dirname(dtb_path), "-maxdepth", "1", "-type", "f",
-             "-name", "*.dtb", "-printf", "- %f\\n"],
-            text=True).rstrip()
-        if dtb_list.count('\n') > 0:
+        dtb_basenames = _list_dtbs(os.path.dirname(dtb_path))
+        if len(dtb_basenames) > 1:
             log.error("Please use --device-tree to pass one of the device "
                       "trees below as the assumed default:")
-            log.error(dtb_list)
+            for dtb_basename in dtb_basenames:
+                log.error(f"- {dtb_basename}")
             sys.exit(1)
         else:
             log.info("Proceeding with the following device tree as the assumed default:")
-            log.info(dtb_list)
+            for dtb_basename in dtb_basenames:
+                log.info(f"- {dtb_basename}")
     if args.device_tree and args.device_tree.endswith(".dtb"):
         dtb_path = os.path.join(os.path.dirname(dtb_path), args.device_tree)
 
-    # Extract compatibility labels from the device tree blob,
-    # and use them for building regexp patterns for matching with compatible
-    # device tree source files.
+    # Extract compatibility labels from the device tree blob, and look for device tree
+    # overlay source files having any of them in a compatible property, for example:
     #
-    # Samples of such patterns:
-    # ^[[:blank:]]*compatible *= *"toradex,colibri-imx8x-aster"
-    # ^[[:blank:]]*compatible *= *"toradex,colibri-imx8x"
-    # ^[[:blank:]]*compatible *= *"fsl,imx8qxp"
-    with tempfile.NamedTemporaryFile(delete=False) as tmpf:
-        compat_regexps_tmp_path = tmpf.name
+    #   compatible = "toradex,colibri-imx8x-aster", "toradex,colibri-imx8x", "fsl,imx8qxp";
     if args.device_tree and args.device_tree.endswith(".dts"):
         # The user passed a device tree source file to check compatibility against;
         # parse the textual content of the file.
         try:
-            # About the 'sed' invocations below:
-            # 1. The first 'sed' scans the device tree source file and extracts
-            #    the first block from "compatible =" to the semicolon.
-            # 2. The second sed filters out the "source noise" of the
-            #    compatibility values;
-            # 3. The final 'sed' prepends '^[[:blank:]]*compatible *= *'
-            #    to the compatibility values.
-            subprocess.check_output(
-                "set -o pipefail && "
-                "sed -r -e '/^[[:blank:]]*compatible *=/,/;/!d' "
-                f"-e '/;/q' {shlex.quote(dtb_path)} | tr -d '\n' | "
-                "sed -r -e 's/.*\\<compatible *= *//' "
-                "-e 's/[[:blank:]]*//g' -e 's/\";.*/\"\\n/' -e 's/\",\"/\"\\n\"/g'"
-                f">{shlex.quote(compat_regexps_tmp_path)}",
-                shell=True, text=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as exc:
-            log.error(exc.output.strip())
+            with open(dtb_path, "r", encoding="utf-8", errors="replace") as dtsf:
+                compat_labels = get_dts_compatible_labels(dtsf.read())
+        except OSError as exc:
+            log.error(exc)
             log.error("error: cannot extract compatibility labels from device "
                       f"tree source '{dtb_path}'")
             sys.exit(1)
     else:
         # The device tree is a blob file from the image.
         try:
-            # About the 'sed' programs below:
-            #  -e 's/$/\"/' appends '"' to each line
-            subprocess.check_output(
-                f"set -o pipefail && fdtget {shlex.quote(dtb_path)} / compatible | tr ' ' '\n' "
-                f"| sed -e 's/$/\"/' >{shlex.quote(compat_regexps_tmp_path)}",
-                shell=True, text=True, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as exc:
-            log.error(exc.output.strip())
-            if "FDT_ERR_BADMAGIC" in exc.output:
+            compat_labels = dt.get_dtb_compatible_labels(dtb_path)
+        except (OSError, libfdt.FdtException) as exc:
+            log.error(exc)
+            if isinstance(exc, libfdt.FdtException) and exc.err == -libfdt.BADMAGIC:
                 log.error(f"error: bad file format -- is '{dtb_path}' a device tree blob?")
             else:
                 log.error("error: cannot extract compatibility labels from "
@@ -247,16 +326,13 @@ def do_dto_list(args):
             sys.exit(1)
 
     # Show all device tree overlay source files that are compatible with the device tree blob.
-    # Given the regexp patterns mentioned above, 'grep' can easily scan for all compatible
-    # files under a given subdirectory.
-    try:
-        compat_list = subprocess.check_output(
-            f"set -o pipefail && grep -rlHEf {shlex.quote(compat_regexps_tmp_path)} "
-            f"{shlex.quote(overlays_subdir)} "
-            "| sort -u | sed -e 's/^/- /'", shell=True, text=True).strip()
+    compat_paths = dto.find_compatible_overlays(
+        overlays_subdir, compat_labels,
+        cache_path=os.path.join(args.storage_directory, dto.COMPATIBLE_SCAN_CACHE))
+    if compat_paths:
         log.info(f"Overlays compatible with device tree {os.path.basename(dtb_path)}:")
-        log.info(f"{compat_list}")
-    except: # pylint: disable=W0702
+        log.info("\n".join(f"- {compat_path}" for compat_path in compat_paths))
+    else:
         log.info("No overlays compatible with device tree "
                  f"{os.path.basename(dtb_path)} were found.")
 
@@ -264,10 +340,7 @@ def do_dto_list(args):
 def do_dto_status(args):
     '''Perform the 'dto status' command.'''
 
-    images_unpack_executed(args.storage_directory)
-    if unpacked_image_type(args.storage_directory) == "raw":
-        raise InvalidDataError("dto commands are not supported for WIC/raw images. "
-                               "Aborting.")
+    _check_unpacked(args.storage_directory)
 
     # Show the enabled device tree.
     (dtb_path, is_dtb_exact) = dt.get_current_dtb_path(args.storage_directory)
@@ -285,10 +358,9 @@ def do_dto_status(args):
 def dto_remove_single(dtob_basename, storage_dir, presence_required=True):
     '''Remove a single overlay.'''
 
-    images_unpack_executed(storage_dir)
-    if unpacked_image_type(storage_dir) == "raw":
-        raise InvalidDataError("dto commands are not supported for WIC/raw images. "
-                               "Aborting.")
+    _check_unpacked(storage_dir)
+    dt_changes_dir = dt.get_dt_changes_dir(storage_dir)
+    dtb_changes_dir = dt.get_dtb_changes_dir(storage_dir)
 
     dtob_basenames = dto.get_applied_overlays_base_names(storage_dir)
     if not dtob_basename in dtob_basenames:
@@ -303,12 +375,9 @@ def dto_remove_single(dtob_basename, storage_dir, presence_required=True):
     dtob_basenames.remove(dtob_basename)
 
     # Create a overlays.txt file without the reference to the removed overlay.
-    dt_changes_dir = dt.get_dt_changes_dir(storage_dir)
-    overlays_txt_target_path = \
-        os.path.join(dt_changes_dir, dt.get_dtb_kernel_subdir(storage_dir), "overlays.txt")
-    os.makedirs(os.path.dirname(overlays_txt_target_path), exist_ok=True)
-    with open(overlays_txt_target_path, "w") as ovlf:
-        ovlf.write("fdt_overlays=" + " ".join(dtob_basenames) + "\n")
+    overlays_txt_target_path = f"{dtb_changes_dir}/overlays.txt"
+    _write_if_changed(overlays_txt_target_path,
+                      "fdt_overlays=" + " ".join(dtob_basenames) + "\n")
 
     # Remove the overlay blob if it's not deployed.
     dtob_path = dto.find_path_to_overlay(storage_dir, dtob_basename)
@@ -321,24 +390,17 @@ def dto_remove_single(dtob_basename, storage_dir, presence_required=True):
 def dto_remove_all(storage_dir):
     '''Remove all overlays currently applied.'''
 
-    images_unpack_executed(storage_dir)
-    if unpacked_image_type(storage_dir) == "raw":
-        raise InvalidDataError("dto commands are not supported for WIC/raw images. "
-                               "Aborting.")
+    _check_unpacked(storage_dir)
 
     log.debug("Removing all overlays")
 
     # Deploy an empty overlays config file.
-    dt_changes_dir = dt.get_dt_changes_dir(storage_dir)
-    overlays_txt_target_path = os.path.join(
-        dt_changes_dir, dt.get_dtb_kernel_subdir(storage_dir), "overlays.txt")
-    os.makedirs(os.path.dirname(overlays_txt_target_path), exist_ok=True)
-    with open(overlays_txt_target_path, "w") as file:
-        file.write("fdt_overlays=\n")
+    dtb_changes_dir = dt.get_dtb_changes_dir(storage_dir)
+    overlays_txt_target_path = f"{dtb_changes_dir}/overlays.txt"
+    _write_if_changed(overlays_txt_target_path, "fdt_overlays=\n")
 
     # Wipe out all overlay blobs as external changes.
-    dtob_target_dir = os.path.join(
-        dt_changes_dir, dt.get_dtb_kernel_subdir(storage_dir), "overlays")
+    dtob_target_dir = f"{dtb_changes_dir}/overlays"
     shutil.rmtree(dtob_target_dir, ignore_errors=True)
 
     # Sanity check.
@@ -372,11 +434,16 @@ def do_dto_deploy(args):
     and less error-prone to the user.
     """
 
-    # Download TEZI image and checkout Device Tree files.
+    # Download TEZI image (unless it is already in the storage from a previous run)
+    # and checkout Device Tree files.
     args.remove_storage = True
     setattr(args, 'update', False)
-    images_cli.do_images_download(args)
-    dt_cli.do_dt_checkout(args)
+    remote_image = images_cli.get_remote_image_url(args)
+    if not images_cli.reuse_downloaded_image(args, remote_image[1]):
+        images_cli.do_images_download(args, remote_image)
+        dt_cli.do_dt_checkout(args)
+    elif not os.path.exists(os.path.abspath("device-trees")):
+        dt_cli.do_dt_checkout(args)
 
     # Remove all applied overlays
     if args.clear:
@@ -385,9 +452,13 @@ def do_dto_deploy(args):
         do_dto_remove(args)
 
     # Apply all Device Tree overlay file(s) passed in the command line.
-    for dtos_path in args.dtos_paths:
-        args.dtos_path = dtos_path
-        do_dto_apply(args)
+    _prepare_apply_args(args)
+    dto_apply_batch(dtos_paths=args.dtos_paths,
+                    dtb_path=args.device_tree,
+                    include_dirs=args.include_dirs,
+                    storage_dir=args.storage_directory,
+                    allow_reapply=False,
+                    test_apply=not args.force)
 
     # Create an ostree overlay.
     union_branch = "dto_deploy"
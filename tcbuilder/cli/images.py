@@ -2,12 +2,13 @@
 CLI handling for images subcommand
 """
 
+import json
 import logging
 import os
 import shutil
 import sys
 
-from tcbuilder.backend import images, common
+from tcbuilder.backend import images, common, dt
 from tcbuilder.errors import UserAbortError, TorizonCoreBuilderError
 from tezi.errors import TeziError
 
@@ -17,6 +18,15 @@ PROV_MODE_OFFLINE = "offline"
 PROV_MODE_ONLINE = "online"
 PROV_MODES = (PROV_MODE_OFFLINE, PROV_MODE_ONLINE)
 
+# Information about the last image downloaded, relative to the storage directory.
+DOWNLOADED_IMAGE_INFO = os.path.join(common.STORAGE_CACHE_DIR, "images-download.json")
+
+
+def get_main_dirs(storage_dir):
+    """Get the directories of the storage holding an unpacked image."""
+    return [os.path.join(storage_dir, dirname)
+            for dirname in ("tezi", "sysroot", "ostree-archive")]
+
 
 def get_extra_dirs(storage_dir, main_dirs):
     """
@@ -52,8 +62,7 @@ def prepare_storage(storage_directory, remove_storage):
         os.mkdir(storage_dir)
 
     # Main directories: will be cleared and returned by this function.
-    main_dirs = [os.path.join(storage_dir, dirname)
-                 for dirname in ("tezi", "sysroot", "ostree-archive")]
+    main_dirs = get_main_dirs(storage_dir)
 
     # Extra directories: will be cleared but not returned.
     extra_dirs = get_extra_dirs(storage_dir, main_dirs)
@@ -74,18 +83,80 @@ def prepare_storage(storage_directory, remove_storage):
     for src_dir in all_dirs:
         if os.path.exists(src_dir):
             shutil.rmtree(src_dir)
+    # The deployment (and thus its kernel directory) and the image.json file
+    # are about to be replaced.
+    dt.get_dtb_kernel_subdir.cache_clear()
+    dt.clear_dtb_compatible_labels_cache()
+    common.invalidate_rootfs_tarball_cache()
 
     return main_dirs
 
 
-def do_images_download(args):
-    """Run 'images download' subcommand"""
+def get_remote_image_url(args):
+    """Get the address of the device and the URL of the image it is running
+
+    The device is given by the `remote_*` arguments.
+
+    :return: A (r_ip, url) tuple.
+    """
 
     r_ip = common.resolve_remote_host(args.remote_host, args.mdns_source)
+    url = images.get_tezi_image_url(r_ip, args.remote_username, args.remote_password,
+                                    args.remote_port)
+    return r_ip, url
+
+
+def do_images_download(args, remote_image=None):
+    """Run 'images download' subcommand
+
+    :param remote_image: The (r_ip, url) tuple returned by get_remote_image_url()
+                         when already known (to avoid querying the device again).
+    """
+
+    if remote_image is None:
+        remote_image = get_remote_image_url(args)
+    r_ip, url = remote_image
     dir_list = prepare_storage(args.storage_directory, args.remove_storage)
     images.download_tezi(r_ip, args.remote_username, args.remote_password,
                          args.remote_port,
-                         dir_list[0], dir_list[1], dir_list[2])
+                         dir_list[0], dir_list[1], dir_list[2], url=url)
+
+    info_path = os.path.join(os.path.abspath(args.storage_directory), DOWNLOADED_IMAGE_INFO)
+    os.makedirs(os.path.dirname(info_path), exist_ok=True)
+    with open(info_path, "w", encoding="utf-8") as infof:
+        json.dump({"url": url}, infof)
+
+
+def reuse_downloaded_image(args, url):
+    """Reset the storage to the image previously downloaded for the device, if any.
+
+    This is a cheaper alternative to `do_images_download()`: when the image at `url`
+    (as returned by get_remote_image_url()) is the last one downloaded into the
+    storage, all changes done on top of it are discarded (as if it had just been
+    downloaded) and True is returned. Otherwise the storage is left untouched and
+    False is returned.
+    """
+
+    storage_dir = os.path.abspath(args.storage_directory)
+    try:
+        common.images_unpack_executed(storage_dir)
+        with open(os.path.join(storage_dir, DOWNLOADED_IMAGE_INFO), "r",
+                  encoding="utf-8") as infof:
+            downloaded_url = json.load(infof).get("url")
+    except (TorizonCoreBuilderError, OSError, ValueError, AttributeError):
+        return False
+
+    if url != downloaded_url:
+        return False
+
+    keep_dirs = get_main_dirs(storage_dir) + [
+        os.path.dirname(os.path.join(storage_dir, DOWNLOADED_IMAGE_INFO))]
+    for extra_dir in get_extra_dirs(storage_dir, keep_dirs):
+        shutil.rmtree(extra_dir)
+    dt.get_dtb_kernel_subdir.cache_clear()
+    dt.clear_dtb_compatible_labels_cache()
+    log.info(f"Reusing image previously downloaded from: {url}")
+    return True
 
 
 def do_images_provision(args):
@@ -252,3 +252,62 @@ load 'lib/common.bash'
       assert_output --partial "invalid registry specified"
     done
 }
+
+@test "bundle: check --registry-cache parameter" {
+    local ci_dockerhub_login="$(ci-dockerhub-login-flag)"
+
+    # Use a basic compose file.
+    local COMPOSE='docker-compose.yml'
+    cp "$SAMPLES_DIR/compose/hello/docker-compose.yml" "$COMPOSE"
+
+    # The cache container is started (or reused from a previous run).
+    rm -rf bundle
+    run torizoncore-builder --log-level debug bundle --registry-cache "$COMPOSE" \
+        ${ci_dockerhub_login:+"--login" "${CI_DOCKER_HUB_PULL_USER}" "${CI_DOCKER_HUB_PULL_PASSWORD}"}
+    assert_success
+    assert_output --regexp "Using registry cache at [0-9.]+:22377"
+    assert_file_exist bundle/docker-storage.tar.xz
+
+    # The cache container is kept running and reused on the next run.
+    rm -rf bundle
+    run torizoncore-builder --log-level debug bundle --registry-cache "$COMPOSE" \
+        ${ci_dockerhub_login:+"--login" "${CI_DOCKER_HUB_PULL_USER}" "${CI_DOCKER_HUB_PULL_PASSWORD}"}
+    assert_success
+    refute_output --partial "Starting registry cache container"
+    refute_output --partial "Recreating registry cache container"
+    assert_output --regexp "Using registry cache at [0-9.]+:22377"
+    assert_file_exist bundle/docker-storage.tar.xz
+
+    rm -f "$COMPOSE"
+    rm -rf bundle
+}
+
+@test "bundle: check --tmpfs-size parameter" {
+    local ci_dockerhub_login="$(ci-dockerhub-login-flag)"
+
+    # Use a basic compose file.
+    local COMPOSE='docker-compose.yml'
+    cp "$SAMPLES_DIR/compose/hello/docker-compose.yml" "$COMPOSE"
+
+    # Test with invalid sizes.
+    local INVALID_SIZES=("0" "8gb" "size" "-1g")
+    for size in "${INVALID_SIZES[@]}"; do
+        rm -rf bundle
+        run torizoncore-builder bundle --tmpfs-size "$size" "$COMPOSE"
+        assert_failure
+        assert_output --partial "Error: invalid tmpfs size '$size'"
+        assert_output --partial "suffixes k, m, g, t, p or e (in any case) or by %"
+        assert_file_not_exist bundle
+    done
+
+    # Test with a valid size.
+    rm -rf bundle
+    run torizoncore-builder --log-level debug bundle --tmpfs-size 1g "$COMPOSE" \
+        ${ci_dockerhub_login:+"--login" "${CI_DOCKER_HUB_PULL_USER}" "${CI_DOCKER_HUB_PULL_PASSWORD}"}
+    assert_success
+    assert_output --partial "Using tmpfs of size 1g for the DinD storage"
+    assert_file_exist bundle/docker-storage.tar.xz
+
+    rm -f "$COMPOSE"
+    rm -rf bundle
+}
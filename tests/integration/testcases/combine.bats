@@ -247,3 +247,41 @@ load 'lib/common.bash'
 
     rm -rf "$COMPOSE" "$OUTPUT_DIR" "$IMAGE_DIR"
 }
+
+@test "combine: check if the unpacked size recorded by bundle is used" {
+    local ci_dockerhub_login="$(ci-dockerhub-login-flag)"
+
+    local COMPOSE='docker-compose.yml'
+    cp "$SAMPLES_DIR/compose/hello/docker-compose.yml" "$COMPOSE"
+
+    rm -rf bundle
+    run torizoncore-builder bundle "$COMPOSE" \
+        ${ci_dockerhub_login:+"--login" "${CI_DOCKER_HUB_PULL_USER}" "${CI_DOCKER_HUB_PULL_PASSWORD}"}
+    assert_success
+    assert_file_exist bundle/docker-storage.tar.xz.size
+
+    # Record a size differing from the real one: only the recorded size can
+    # then explain the resulting uncompressed_size (1 GiB is way larger than
+    # the unpacked tarball of the sample compose file).
+    local TAR_SIZE=1073741824
+    echo "$TAR_SIZE" > bundle/docker-storage.tar.xz.size
+
+    unpack-image $DEFAULT_TEZI_IMAGE
+    local IMAGE_DIR=$(echo $DEFAULT_TEZI_IMAGE | sed 's/\.tar$//g')
+    local OUTPUT_DIR=$(mktemp -d -u tmpdir.XXXXXXXXXXXXXXXXXXXXXXXXX)
+
+    run torizoncore-builder combine $IMAGE_DIR $OUTPUT_DIR
+    assert_success
+
+    # The rootfs uncompressed size must have grown by exactly the recorded size.
+    local JQ_SIZE='[(.blockdevs[]?.partitions[]?.content | select(.label == "otaroot")),
+                    (.mtddevs[]? | select(.name == "ubi") | .ubivolumes[]
+                     | select(.name == "rootfs") | .content)][0].uncompressed_size'
+    local ORIG_SIZE=$(jq "$JQ_SIZE" "$IMAGE_DIR/image.json")
+    local NEW_SIZE=$(jq "$JQ_SIZE" "$OUTPUT_DIR/image.json")
+    run awk -v orig="$ORIG_SIZE" -v new="$NEW_SIZE" -v tar="$TAR_SIZE" \
+        'BEGIN { diff = new - orig - tar / 1024 / 1024; exit !(diff < 0.01 && diff > -0.01) }'
+    assert_success
+
+    rm -rf "$COMPOSE" bundle "$OUTPUT_DIR" "$IMAGE_DIR"
+}
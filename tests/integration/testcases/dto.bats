@@ -56,6 +56,55 @@ bats_load_library 'bats/bats-file/load.bash'
     assert_output --partial "_overlay.dts"
 }
 
+@test "dto: list only overlays having a compatible label as first value" {
+    torizoncore-builder images --remove-storage unpack $DEFAULT_TEZI_IMAGE
+    rm -rf device-trees
+
+    run torizoncore-builder dt checkout --update
+    if is-major-version-greater-than-5; then
+        assert_failure
+        skip "dt checkout not available on TC6+"
+    fi
+    assert_success
+
+    local DTB_ARGS=()
+    run torizoncore-builder dto list
+    if grep -q "Could not determine default device tree" <<< $output; then
+        local DTB=$(echo "$output" | sed -nE -e 's/^- (.*\.dtb)/\1/p' | head -1)
+        DTB_ARGS=(--device-tree $DTB)
+        run torizoncore-builder dto list "${DTB_ARGS[@]}"
+    fi
+    assert_success
+
+    # Take the first label of an overlay known to be compatible.
+    local OVERLAY=$(echo "$output" | sed -nE -e 's/^- (.*\.dts)$/\1/p' | head -1)
+    local LABEL=$(sed -nE -e 's/^\s*compatible\s*=\s*"([^"]+)".*/\1/p' "$OVERLAY" | head -1)
+    assert [ -n "$LABEL" ]
+
+    cat > device-trees/overlays/tcb-first-label_overlay.dts <<EOF
+/dts-v1/;
+/plugin/;
+/ {
+	compatible = "$LABEL";
+};
+EOF
+    cat > device-trees/overlays/tcb-second-label_overlay.dts <<EOF
+/dts-v1/;
+/plugin/;
+/ {
+	compatible = "tcb,not-a-real-board",
+		     "$LABEL";
+};
+EOF
+
+    run torizoncore-builder dto list "${DTB_ARGS[@]}"
+    assert_success
+    assert_output --partial "tcb-first-label_overlay.dts"
+    refute_output --partial "tcb-second-label_overlay.dts"
+
+    rm -rf device-trees
+}
+
 @test "dto: apply overlay in the image without images unpack" {
     torizoncore-builder-clean-storage
 
@@ -165,3 +214,33 @@ bats_load_library 'bats/bats-file/load.bash'
     assert_output --partial "Error: could not find an Easy Installer or WIC image in the storage."
     assert_output --partial "Please use the 'images' command to unpack an image before running this command."
 }
+
+# bats test_tags=requires-device
+@test "dto: deploy overlay reusing the downloaded image" {
+    requires-device
+    torizoncore-builder-clean-storage
+
+    # Notice the device is not rebooted: the image running on it stays the same.
+    run torizoncore-builder dto deploy \
+        --remote-host $DEVICE_ADDR --remote-username $DEVICE_USER \
+        --remote-password $DEVICE_PASSWORD --remote-port $DEVICE_PORT \
+        --force $SAMPLES_DIR/dts/sample_overlay.dts
+    assert_success
+    refute_output --partial "Reusing image previously downloaded from"
+    assert_output --partial "Overlay sample_overlay.dtbo successfully applied"
+    assert_output --partial "Deploying successfully finished"
+
+    # The image downloaded by the previous run is still current.
+    run torizoncore-builder dto deploy \
+        --remote-host $DEVICE_ADDR --remote-username $DEVICE_USER \
+        --remote-password $DEVICE_PASSWORD --remote-port $DEVICE_PORT \
+        --force $SAMPLES_DIR/dts/sample_overlay.dts
+    assert_success
+    assert_output --partial "Reusing image previously downloaded from"
+    assert_output --partial "Overlay sample_overlay.dtbo successfully applied"
+    assert_output --partial "Deploying successfully finished"
+
+    run torizoncore-builder dto status
+    assert_success
+    assert_output --partial "sample_overlay.dtbo"
+}
@@ -1,14 +1,14 @@
 """Helpers for handling image.json file in a TEZI Image."""
 
+import errno
 import json
 import logging
 import os
-import shlex
-import subprocess
 
 from tezi.errors import (TeziError, InvalidDataError,
                          SourceInFilelistError, TargetInFilelistError)
-from tezi.utils import get_unpack_command
+from tezi.utils import (get_unpack_command, get_uncompressed_size,
+                         get_xz_uncompressed_size)
 
 log = logging.getLogger("torizon." + __name__)
 
@@ -60,8 +60,8 @@ class ImageConfig:
             self.json_data = json.load(infile)
         self.fname = fname
 
-    def add_files(self, entries, image_dir=None,
-                  update_size=False, fail_src_present=True, fail_tgt_present=True):
+    def add_files(self, entries, image_dir=None, update_size=False,
+                  fail_src_present=True, fail_tgt_present=True, unpacked_sizes=None):
         """Add files to the 'filelist' element
 
         The 'filelist' element of a Toradex Easy Installer configuration file
@@ -83,6 +83,9 @@ class ImageConfig:
         :param fail_tgt_present: Fail if a destination directory is already present in the
                                  current 'filelist'; this should be set to True if the given
                                  source file is expected to be unique in the 'filelist'.
+        :param unpacked_sizes: Optional dictionary mapping source file names to their
+                               already known (unpacked) sizes in bytes; these files
+                               will not be read when updating the size.
 
         In case of an error an exception derived from `TeziError` will be raised.
         """
@@ -106,15 +109,25 @@ class ImageConfig:
                 decoded = self._decode_flentry(flentry)
                 curr_tgts.add(os.path.normpath(decoded["tgt"]))
 
+        decoded_entries = [self._decode_flentry(flentry) for flentry in entries]
+
+        dir_entries = {}
+        if update_size:
+            dir_entries = self._scan_image_dir(image_dir, decoded_entries)
+
         extra_size = 0
-        for flentry in entries:
-            decoded = self._decode_flentry(flentry)
+        for decoded in decoded_entries:
             if fail_src_present and os.path.normpath(decoded["src"]) in curr_srcs:
                 raise SourceInFilelistError(f"{decoded['src']} already in filelist")
             if fail_tgt_present and os.path.normpath(decoded["tgt"]) in curr_tgts:
                 raise TargetInFilelistError(f"{decoded['tgt']} already in filelist")
             if update_size:
-                _size_bytes = self._get_size(image_dir, decoded["src"], decoded["unpack"])
+                if unpacked_sizes and decoded["src"] in unpacked_sizes:
+                    _size_bytes = unpacked_sizes[decoded["src"]]
+                else:
+                    _size_bytes = self._get_size(
+                        image_dir, decoded["src"], decoded["unpack"],
+                        dir_entries.get(os.path.normpath(decoded["src"])))
                 extra_size += _size_bytes / 1024 / 1024
             self.rootfs_filelist.append(self._encode_flentry(decoded))
 
@@ -157,19 +170,47 @@ class ImageConfig:
         return ":".join(entry)
 
     @staticmethod
-    def _get_size(image_dir, filename, unpack):
-        """Get the size of a file possibly uncompressing it"""
+    def _scan_image_dir(image_dir, decoded_entries):
+        """Scan the image directory checking the given sources exist in it
+
+        Scanning the directory once reports missing files before any (possibly
+        lengthy) size computation takes place.
+
+        :return: Dictionary mapping file names to their `os.DirEntry`.
+        """
+
+        with os.scandir(image_dir) as scan:
+            dir_entries = {entry.name: entry for entry in scan}
+        for decoded in decoded_entries:
+            src = os.path.normpath(decoded["src"])
+            if os.sep not in src and src not in dir_entries:
+                raise FileNotFoundError(
+                    errno.ENOENT, os.strerror(errno.ENOENT), os.path.join(image_dir, src))
+        return dir_entries
+
+    @staticmethod
+    def _get_size(image_dir, filename, unpack, dir_entry=None):
+        """Get the size of a file possibly uncompressing it
+
+        :param dir_entry: Optional `os.DirEntry` of the file (from a scan of
+                          `image_dir`) to take its status from.
+        """
 
         full_fname = os.path.join(image_dir, filename)
-        if unpack:
-            _output = subprocess.check_output(
-                "set -o pipefail; "
-                f"cat {shlex.quote(full_fname)} | {get_unpack_command(filename)} | wc -c",
-                shell=True)
-            size = int(_output)
-        else:
-            stat = os.stat(full_fname)
+        unpack_command = get_unpack_command(filename)
+        if unpack and unpack_command == "cat" and not filename.lower().endswith(".tar"):
+            raise InvalidDataError(f"Cannot determine how to unpack {filename}")
+        if not unpack or unpack_command == "cat":
+            # Not compressed: the unpacked size is the size of the file itself.
+            stat = dir_entry.stat() if dir_entry is not None else os.stat(full_fname)
             size = stat.st_size
+        else:
+            size = None
+            if filename.lower().endswith(".xz"):
+                # Cheap path: read the sizes from the xz index.
+                size = get_xz_uncompressed_size(full_fname)
+            if size is None:
+                size = get_uncompressed_size(full_fname)
         log.debug(f"Size of {full_fname} is {size} bytes.")
         return size
 
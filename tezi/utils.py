@@ -1,3 +1,10 @@
+import bz2
+import gzip
+import lzma
+import os
+import shlex
+import subprocess
+
 UNPACK_COMMANDS_MAP = {
     ".gz": "gzip -dc",
     ".tgz": "gzip -dc",
@@ -8,6 +15,17 @@ UNPACK_COMMANDS_MAP = {
     ".bz2": "bzip2 -dc"
 }
 
+# Formats that can be decompressed by the Python standard library.
+UNPACK_OPENERS_MAP = {
+    ".gz": gzip.open,
+    ".tgz": gzip.open,
+    ".xz": lzma.open,
+    ".bz2": bz2.open
+}
+
+# Size of the chunks read when counting the bytes of a decompressed stream.
+READ_CHUNK_SIZE = 1024 * 1024
+
 
 def find_rootfs_content(jsondata):
     """ Finds root filesystem content data from given image json object
@@ -39,8 +57,73 @@ def find_rootfs_content(jsondata):
 
 
 def get_unpack_command(filename):
-    """Get shell command to unpack a given file format"""
-    for ext, cmd in UNPACK_COMMANDS_MAP.items():
-        if filename.endswith(ext):
-            return cmd
-    return "cat"
+    """Get shell command to unpack a given file format
+
+    The extension is matched case-insensitively; "cat" is returned for files
+    not having any of the known compression extensions.
+    """
+    return UNPACK_COMMANDS_MAP.get(os.path.splitext(filename)[1].lower(), "cat")
+
+
+def get_xz_uncompressed_size(filename):
+    """Get the uncompressed size of a .xz file without decompressing it
+
+    The sizes are taken from the index stored at the end of each xz stream,
+    so only the metadata of the file needs to be read.
+
+    Parameters:
+        filename (str): Path to the .xz file
+    Returns:
+        int: Uncompressed size in bytes or None if it cannot be determined
+    """
+    try:
+        output = subprocess.check_output(
+            ["xz", "--robot", "--list", filename], text=True, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    # Line format: totals <streams> <blocks> <compressed> <uncompressed> ...
+    for line in output.splitlines():
+        fields = line.split("\t")
+        if fields[0] == "totals" and len(fields) > 4:
+            return int(fields[4])
+    return None
+
+
+def get_uncompressed_size(filename):
+    """Get the uncompressed size of a file by decompressing it as a stream
+
+    The decompressed data is only counted, never stored. Formats handled by
+    the Python standard library are decompressed in-process; for the others
+    the command from UNPACK_COMMANDS_MAP is run directly (without a shell).
+
+    Parameters:
+        filename (str): Path to the compressed file
+    Returns:
+        int: Uncompressed size in bytes
+    """
+    total = 0
+    opener = UNPACK_OPENERS_MAP.get(os.path.splitext(filename)[1].lower())
+    if opener is not None:
+        with open(filename, "rb") as rawfile:
+            os.posix_fadvise(rawfile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            with opener(rawfile, "rb") as infile:
+                while True:
+                    chunk = infile.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    total += len(chunk)
+        return total
+
+    command = shlex.split(get_unpack_command(filename))
+    with open(filename, "rb") as rawfile:
+        os.posix_fadvise(rawfile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        with subprocess.Popen(command, stdin=rawfile, stdout=subprocess.PIPE) as proc:
+            while True:
+                chunk = proc.stdout.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                total += len(chunk)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+    return total